@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+from collections import Counter
+from datetime import date, timedelta
+from types import SimpleNamespace
+
+from telegram import Bot, Update
+from telegram.request import BaseRequest
+
+import fake_telegram
+
+# Benchmarks the bot's handlers on synthetic marketplaces (N sellers x M items spread over
+# the categories). Real handlers and real telegram objects are used; only the HTTP layer
+# is replaced, so outgoing calls are counted and answered locally instead of sent.
+#
+#   python bench.py --sellers 100,1000,10000 --items 10 --output bench.json
+#   python bench.py --sellers 100,1000,10000 --items 10 --compare bench.json
+#
+# Results are JSON: one record per marketplace size and handler with p50/p99 latency,
+# throughput, peak memory and Bot API calls per handler call. --compare checks them
+# against an earlier run and exits with 1 if something got slower than --threshold.
+# The 'import' record (0 sellers) is the time a fresh interpreter takes to import the
+# handlers package, so slow imports added at module level show up as regressions too.
+
+WORDS = ["стол", "стул", "шкаф", "куртка", "чайник", "лампа", "диван", "пальто", "утюг", "полка",
+         "новый", "старый", "большой", "красный", "деревянный", "зимний"]
+
+
+class RecordingRequest(BaseRequest):
+    # Answers Bot API calls like fake_telegram.py does and counts them by method
+    def __init__(self):
+        self.calls = Counter()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if method == "GET":  # file download
+            return 200, fake_telegram.FAKE_FILE
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+        result = fake_telegram.fake_result(api_method, params)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def generate_marketplace(storage, categories, sellers, items_per_seller, rng):
+    # Listings are up to 40 days old, so about a quarter of them are due to expire
+    today = date.today()
+    for seller_id in range(1, sellers + 1):
+        items = []
+        for n in range(items_per_seller):
+            items.append({
+                'id': f"{seller_id:016x}{n:016x}",
+                'category': rng.choice(categories),
+                'name': f"{rng.choice(WORDS)} {rng.choice(WORDS)}",
+                'price': float(rng.randint(100, 50000)),
+                'contact_number': "+79990000000",
+                'photo_file_id': f"photo-{seller_id}-{n}",
+                'thumb_file_id': f"thumb-{seller_id}-{n}",
+                'created_at': (today - timedelta(days=rng.randint(0, 40))).isoformat(),
+            })
+        storage.save_items(seller_id, items)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[round(q * (len(values) - 1))]
+
+
+def scenarios(handlers, bot, rng, sellers):
+    # name -> function returning (handler, update, context) for one call
+    item_ids = list(handlers.listings.ITEM_INDEX)
+    buyer_ids = iter(range(10 ** 6, 10 ** 7))
+
+    def context(args=()):
+        return SimpleNamespace(user_data={}, args=list(args), bot=bot)
+
+    def callback(data):
+        update = Update.de_json(fake_telegram.callback_update(next(buyer_ids), data), bot)
+        return handlers.routes.button_handler, update, context()
+
+    def text(handler, value, user_id=None):
+        update = Update.de_json(fake_telegram.text_update(user_id or next(buyer_ids), value), bot)
+        return handler, update, context(value.split()[1:])
+
+    def category_index():
+        return rng.randrange(len(handlers.state.CATEGORIES))
+
+    pack = handlers.state.CALLBACKS.pack
+    return {
+        'show_items_in_category': lambda: callback(pack(handlers.browse.show_items_in_category, category_index())),
+        'show_category_page': lambda: callback(pack(handlers.browse.show_category_page_callback, category_index(),
+                                                    rng.randint(1, 5))),
+        'show_item_card': lambda: callback(pack(handlers.browse.show_item_card, rng.choice(item_ids))),
+        'search_command': lambda: text(handlers.browse.search_command, f"/search {rng.choice(WORDS)}"),
+        'handle_profile_text': lambda: text(handlers.account.handle_profile_text, "👤 Профиль", rng.randint(1, sellers)),
+        # Buying changes the marketplace, so it runs after the read-only handlers
+        'handle_buy_item': lambda: callback(pack(handlers.browse.handle_buy_item, rng.choice(item_ids))),
+    }
+
+
+async def measure(make_call, calls, memory_calls, request):
+    prepared = [make_call() for _ in range(calls)]
+    request.calls.clear()
+    latencies = []
+    started = time.perf_counter()
+    for handler, update, context in prepared:
+        call_started = time.perf_counter()
+        await handler(update, context)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    api_calls = sum(request.calls.values())
+
+    # Memory is traced in a separate, shorter pass: tracemalloc slows everything down
+    prepared = [make_call() for _ in range(memory_calls)]
+    tracemalloc.start()
+    for handler, update, context in prepared:
+        await handler(update, context)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'calls': calls,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'throughput_per_s': round(calls / elapsed, 1),
+        'peak_kib': round(peak / 1024, 1),
+        'api_calls_per_call': round(api_calls / calls, 2),
+    }
+
+
+def measure_import(runs):
+    # Importing the handlers in a fresh interpreter, as on every restart; the interpreter's
+    # own startup is not included
+    code = ("import sys, time; sys.path.insert(0, sys.argv[1]); started = time.perf_counter(); "
+            "import handlers; print(time.perf_counter() - started)")
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    latencies = [
+        float(subprocess.run([sys.executable, "-c", code, repo_dir], capture_output=True, text=True,
+                             check=True).stdout)
+        for _ in range(runs)
+    ]
+    return {
+        'calls': runs,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'throughput_per_s': round(runs / sum(latencies), 1),
+        'peak_kib': None,
+        'api_calls_per_call': 0,
+    }
+
+
+async def measure_expiry(handlers):
+    # One run removes everything that is due, so it can't be repeated; it is timed with
+    # tracemalloc on, which makes it look slower than the handlers measured above
+    tracemalloc.start()
+    started = time.perf_counter()
+    await handlers.listings.remove_expired_items()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'calls': 1,
+        'p50_ms': round(elapsed * 1000, 3),
+        'p99_ms': round(elapsed * 1000, 3),
+        'throughput_per_s': round(1 / elapsed, 1),
+        'peak_kib': round(peak / 1024, 1),
+        'api_calls_per_call': 0,
+    }
+
+
+async def run_size(handlers, storage_module, bot, request, args, sellers):
+    work_dir = tempfile.mkdtemp(prefix=f"bench-{sellers}-")
+    os.environ['DATA_DIR'] = work_dir
+    os.environ['SQLITE_PATH'] = os.path.join(work_dir, "bench.db")
+    rng = random.Random(args.seed)
+
+    backend = storage_module.open_storage()
+    generate_marketplace(backend, handlers.state.CATEGORIES, sellers, args.items, rng)
+    backend.close()
+
+    storage = handlers.init_storage()
+    started = time.perf_counter()
+    await handlers.listings.build_listings_index()
+    await handlers.state.STATS.load(storage)
+    startup_ms = round((time.perf_counter() - started) * 1000, 3)
+
+    base = {'backend': args.backend, 'sellers': sellers, 'items_per_seller': args.items}
+    results = [dict(base, handler='startup', calls=1, p50_ms=startup_ms, p99_ms=startup_ms,
+                    throughput_per_s=round(1000 / startup_ms, 1), peak_kib=None, api_calls_per_call=0)]
+    for name, make_call in scenarios(handlers, bot, rng, sellers).items():
+        results.append(dict(base, handler=name, **await measure(make_call, args.calls, args.memory_calls, request)))
+    results.append(dict(base, handler='remove_expired_items', **await measure_expiry(handlers)))
+
+    await handlers.state.PURCHASES.flush()
+    await handlers.state.STATS.flush()
+    storage.close()
+    return results
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {
+            (r['backend'], r['sellers'], r['items_per_seller'], r['handler']): r for r in json.load(f)['results']
+        }
+    regressions = 0
+    for result in results:
+        before = baseline.get((result['backend'], result['sellers'], result['items_per_seller'], result['handler']))
+        if before is None:
+            continue
+        ratio = result['p50_ms'] / before['p50_ms'] if before['p50_ms'] else 1.0
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{result['handler']:24} {result['sellers']:>7} sellers  p50 {before['p50_ms']:9.3f} -> "
+              f"{result['p50_ms']:9.3f} ms  (x{ratio:.2f}){flag}", file=sys.stderr)
+    return regressions
+
+
+async def main(args):
+    logging.disable(logging.INFO)
+    os.environ['STORAGE_BACKEND'] = args.backend
+    # Telegram's rate limits would make every handler look as slow as the limit
+    os.environ['OUTBOUND_GLOBAL_RATE'] = os.environ['OUTBOUND_CHAT_RATE'] = "1e9"
+    # Photos go to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="bench-"))
+    import handlers
+    import storage
+
+    results = [dict(backend=args.backend, sellers=0, items_per_seller=0, handler='import',
+                    **measure_import(args.import_runs))]
+    print(f"{'import':24} p50 {results[0]['p50_ms']:9.3f} ms  p99 {results[0]['p99_ms']:9.3f} ms", file=sys.stderr)
+
+    request = RecordingRequest()
+    bot = Bot("1:bench", request=request, get_updates_request=RecordingRequest())
+    await bot.initialize()
+
+    for sellers in args.sellers:
+        size_results = await run_size(handlers, storage, bot, request, args, sellers)
+        for result in size_results:
+            print(f"{result['handler']:24} {sellers:>7} sellers  p50 {result['p50_ms']:9.3f} ms  "
+                  f"p99 {result['p99_ms']:9.3f} ms  {result['throughput_per_s']:>9}/s  "
+                  f"peak {result['peak_kib']} KiB", file=sys.stderr)
+        results.extend(size_results)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'date': date.today().isoformat(),
+            'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the bot's handlers on synthetic marketplaces")
+    parser.add_argument("--sellers", type=lambda value: [int(n) for n in value.split(",")], default=[100, 1000],
+                        help="comma-separated seller counts, one marketplace per count")
+    parser.add_argument("--items", type=int, default=10, help="listings per seller")
+    parser.add_argument("--calls", type=int, default=200, help="timed calls per handler")
+    parser.add_argument("--memory-calls", type=int, default=20, help="calls per handler traced for memory")
+    parser.add_argument("--import-runs", type=int, default=5, help="fresh interpreters timed importing the handlers")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON report to compare p50 latencies against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="p50 ratio counted as a regression")
+    args = parser.parse_args()
+    # Absolute paths, since main() changes the working directory
+    args.output = os.path.abspath(args.output) if args.output else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+    sys.exit(asyncio.run(main(args)))
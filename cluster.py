@@ -0,0 +1,261 @@
+import os
+import sys
+import signal
+import asyncio
+import logging
+import secrets
+import argparse
+
+from webhook import webhook_config, SECRET_HEADER
+
+logger = logging.getLogger(__name__)
+
+# Multi-process mode: a front process receives Telegram's webhook and hands each update to
+# one of N worker processes (ordinary ru.py in webhook mode), always the same one for a
+# user, so per-user state and ordering stay in one process. Workers share listings through
+# SQLite and keep their in-memory indexes in sync with events: each worker posts its
+# listing changes to the front process, which passes them on to every other worker.
+#
+#   STORAGE_BACKEND=sqlite WEBHOOK_URL=https://example.com/telegram python cluster.py --workers 4
+#
+# The front process listens on WEBHOOK_HOST:WEBHOOK_PORT like a single bot would, and on
+# 127.0.0.1:--base-port for events; worker i listens on 127.0.0.1:base-port+1+i.
+# Shard 0 is the primary: it runs the expiry job and writes the shared stats counters.
+# Workers import ClusterEvents at startup, so aiohttp is imported where it is used.
+
+EVENTS_PATH = "/events"
+UPDATES_PATH = "/update"
+
+
+def update_user_id(data):
+    # The user an update comes from, or its chat for updates without a user
+    for value in data.values():
+        if isinstance(value, dict):
+            user = value.get('from') or value.get('user')
+            if user:
+                return user['id']
+            if value.get('chat'):
+                return value['chat']['id']
+    return 0
+
+
+async def post_with_retry(session, url, payload, secret, attempts=20):
+    # Workers may still be starting (or restarting), so connection errors are retried
+    import aiohttp
+    for attempt in range(attempts):
+        try:
+            async with session.post(url, json=payload, headers={SECRET_HEADER: secret}) as response:
+                if response.status != 200:
+                    logger.warning("%s answered %d", url, response.status)
+                return
+        except aiohttp.ClientConnectionError:
+            if attempt == attempts - 1:
+                logger.error("Dropping a message for %s: not reachable", url)
+                return
+            await asyncio.sleep(0.5)
+
+
+class ClusterEvents:
+    # Worker side of the event channel. Without CLUSTER_HUB_URL (a single process) publish()
+    # does nothing and the process is its own primary.
+    def __init__(self, hub_url=None, shard=0, secret=None):
+        self.hub_url = hub_url
+        self.shard = shard
+        self.secret = secret
+        self.pending = []
+        self.send_task = None
+        self.session = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv("CLUSTER_HUB_URL") or None, int(os.getenv("CLUSTER_SHARD", "0")),
+                   os.getenv("CLUSTER_SECRET"))
+
+    @property
+    def enabled(self):
+        return self.hub_url is not None
+
+    @property
+    def is_primary(self):
+        return self.shard == 0
+
+    def publish(self, event):
+        if not self.enabled:
+            return
+        self.pending.append(event)
+        if self.send_task is None:
+            self.send_task = asyncio.create_task(self._send_pending())
+
+    async def _send_pending(self):
+        # Events of one round of the event loop go out in one request, in order
+        await asyncio.sleep(0)
+        try:
+            if self.session is None:
+                import aiohttp
+                self.session = aiohttp.ClientSession()
+            while self.pending:
+                events, self.pending = self.pending, []
+                await post_with_retry(self.session, self.hub_url + EVENTS_PATH,
+                                      {'shard': self.shard, 'events': events}, self.secret)
+        finally:
+            self.send_task = None
+
+    def routes(self, apply):
+        # Webhook routes that receive other workers' events and pass them to apply(events)
+        if not self.enabled:
+            return []
+        from aiohttp import web
+
+        async def receive_events(request):
+            if request.headers.get(SECRET_HEADER) != self.secret:
+                return web.Response(status=403)
+            apply((await request.json())['events'])
+            return web.Response()
+        return [(EVENTS_PATH, receive_events)]
+
+    async def close(self):
+        if self.send_task is not None:
+            await self.send_task
+        if self.session is not None:
+            await self.session.close()
+
+
+class Worker:
+    def __init__(self, shard, port, env):
+        self.shard = shard
+        self.url = f"http://127.0.0.1:{port}"
+        self.env = env
+        self.process = None
+        # One queue and one sender per worker keeps updates of a user in order
+        self.queue = asyncio.Queue()
+
+    async def start(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ru.py")
+        self.process = await asyncio.create_subprocess_exec(sys.executable, script, env=self.env)
+        logger.info("Worker %d started (pid %d) on %s", self.shard, self.process.pid, self.url)
+
+    async def supervise(self, stopping):
+        while True:
+            code = await self.process.wait()
+            if stopping.is_set():
+                return
+            logger.error("Worker %d exited with %s, restarting", self.shard, code)
+            await asyncio.sleep(1)
+            await self.start()
+
+    async def forward(self, session, secret):
+        while True:
+            path, payload = await self.queue.get()
+            await post_with_retry(session, self.url + path, payload, secret)
+
+    async def stop(self):
+        if self.process.returncode is None:
+            # SIGINT makes the worker shut down like a single bot on Ctrl+C
+            self.process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(self.process.wait(), 30)
+            except asyncio.TimeoutError:
+                self.process.kill()
+
+
+def worker_env(shard, port, hub_port, secret):
+    env = dict(os.environ)
+    env.update({
+        'BOT_MODE': "webhook",
+        'WEBHOOK_HOST': "127.0.0.1",
+        'WEBHOOK_PORT': str(port),
+        'WEBHOOK_PATH': UPDATES_PATH,
+        'WEBHOOK_SECRET': secret,
+        'WEBHOOK_URL': "",  # the front process registers the webhook
+        'CLUSTER_HUB_URL': f"http://127.0.0.1:{hub_port}",
+        'CLUSTER_SHARD': str(shard),
+        'CLUSTER_SECRET': secret,
+    })
+    metrics_port = int(os.getenv("METRICS_PORT", "0"))
+    env['METRICS_PORT'] = str(metrics_port + shard if metrics_port else 0)
+    return env
+
+
+async def serve_front(worker_count, base_port):
+    import aiohttp
+    from aiohttp import web
+    from telegram import Bot, Update
+
+    config = webhook_config()
+    secret = secrets.token_hex(16)
+    workers = [
+        Worker(shard, base_port + 1 + shard, worker_env(shard, base_port + 1 + shard, base_port, secret))
+        for shard in range(worker_count)
+    ]
+
+    async def receive_update(request):
+        if request.headers.get(SECRET_HEADER) != config['secret']:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        workers[update_user_id(data) % worker_count].queue.put_nowait((UPDATES_PATH, data))
+        return web.Response()
+
+    async def relay_events(request):
+        if request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=403)
+        payload = await request.json()
+        for worker in workers:
+            if worker.shard != payload['shard']:
+                worker.queue.put_nowait((EVENTS_PATH, payload))
+        return web.Response()
+
+    public_app = web.Application()
+    public_app.router.add_post(config['path'], receive_update)
+    hub_app = web.Application()
+    hub_app.router.add_post(EVENTS_PATH, relay_events)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    runners = []
+    for app, host, port in ((hub_app, "127.0.0.1", base_port), (public_app, config['host'], config['port'])):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        runners.append(runner)
+    logger.info("Front process listening on %s:%d%s, %d workers",
+                config['host'], config['port'], config['path'], worker_count)
+
+    if config['url']:
+        api_url = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+        async with Bot(os.getenv("TELEGRAM_BOT_TOKEN"), base_url=f"{api_url}/bot") as bot:
+            await bot.set_webhook(url=config['url'], secret_token=config['secret'], allowed_updates=Update.ALL_TYPES)
+
+    async with aiohttp.ClientSession() as session:
+        for worker in workers:
+            await worker.start()
+        tasks = [asyncio.create_task(worker.forward(session, secret)) for worker in workers]
+        tasks += [asyncio.create_task(worker.supervise(stopping)) for worker in workers]
+
+        await stopping.wait()
+
+        for runner in reversed(runners):
+            await runner.cleanup()
+        await asyncio.gather(*(worker.stop() for worker in workers))
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Run the bot as a front process and N worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--base-port", type=int, default=8600,
+                        help="internal port of the front process; workers use the following ports")
+    args = parser.parse_args()
+    if os.getenv("STORAGE_BACKEND") != "sqlite":
+        sys.exit("Multi-process mode needs STORAGE_BACKEND=sqlite: JSON files can't be shared between processes")
+    asyncio.run(serve_front(args.workers, args.base_port))
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadWorkers:
+    # A fixed number of background tasks that take jobs from a queue and run them with
+    # handle(job). Telegram and disk errors are retried with exponential backoff.
+    def __init__(self, workers=4, max_attempts=5, retry_delay=2.0):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue = asyncio.Queue()
+        self.tasks = []
+        self.handle = None
+
+    def start(self, handle):
+        self.handle = handle
+        self.tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, job):
+        self.queue.put_nowait(job)
+
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, job):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await self.handle(job)
+                return
+            except (TelegramError, OSError) as error:
+                if attempt == self.max_attempts:
+                    logger.error("Giving up on download %s after %d attempts: %s", job, attempt, error)
+                    return
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.warning("Download %s failed (%s), retrying in %.0f s", job, error, delay)
+                await asyncio.sleep(delay)
+            except Exception:
+                logger.exception("Download %s failed", job)
+                return
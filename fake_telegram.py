@@ -0,0 +1,168 @@
+import json
+import time
+import asyncio
+import argparse
+import itertools
+
+import aiohttp
+from aiohttp import web
+
+# Fake Telegram for trying the bot locally in webhook mode without network access.
+# It answers Bot API calls (printing each one) and posts updates to the bot's webhook.
+#
+#   python fake_telegram.py --secret secret --text /start --text "🛒 Купить товары" \
+#       --callback "1c:1" &    # callback_data as packed by router.py: category 1
+#   BOT_MODE=webhook WEBHOOK_SECRET=secret TELEGRAM_API_URL=http://127.0.0.1:8081 \
+#       TELEGRAM_BOT_TOKEN=1:fake python ru.py
+#
+# Start it first: the bot calls getMe on startup, and updates are retried until the
+# webhook is up.
+
+message_ids = itertools.count(1)
+update_ids = itertools.count(1)
+
+
+def fake_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+
+def fake_message(chat_id, **fields):
+    return {
+        'message_id': next(message_ids),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        **fields,
+    }
+
+
+def text_update(user_id, text):
+    message = fake_message(user_id, text=text, **{'from': fake_user(user_id)})
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': next(update_ids), 'message': message}
+
+
+def photo_update(user_id):
+    photo = [
+        {'file_id': f"fake-photo-{size}", 'file_unique_id': f"fake-{size}", 'width': size, 'height': size}
+        for size in (90, 320, 800)
+    ]
+    message = fake_message(user_id, photo=photo, **{'from': fake_user(user_id)})
+    return {'update_id': next(update_ids), 'message': message}
+
+
+def callback_update(user_id, data):
+    return {
+        'update_id': next(update_ids),
+        'callback_query': {
+            'id': str(next(update_ids)),
+            'from': fake_user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': fake_message(user_id, text="…"),
+        },
+    }
+
+
+def fake_result(method, params):
+    # What the Bot API would answer to a call; also used by bench.py
+    method = method.lower()
+    chat_id = int(params.get('chat_id', 0) or 0)
+    if method == 'getme':
+        return {'id': 1, 'is_bot': True, 'first_name': "Fake", 'username': "fake_bot"}
+    if method in ('sendmessage', 'editmessagetext'):
+        return fake_message(chat_id, text=params.get('text', ''))
+    if method in ('sendphoto', 'editmessagecaption'):
+        photo = [{'file_id': f"fake-{next(message_ids)}", 'file_unique_id': "fake", 'width': 1, 'height': 1}]
+        return fake_message(chat_id, photo=photo, caption=params.get('caption', ''))
+    if method == 'sendmediagroup':
+        return [fake_message(chat_id, text="")]
+    if method == 'getfile':
+        return {'file_id': params['file_id'], 'file_unique_id': "fake", 'file_path': "photos/fake.jpg"}
+    return True
+
+
+FAKE_FILE = b"\xff\xd8\xff\xd9"
+
+
+def create_api_app():
+    async def bot_method(request):
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value if isinstance(value, (str, int, float, dict, list)) else "<file>"
+        print(f"-> {request.match_info['method']} {json.dumps(params, ensure_ascii=False)}")
+        return web.json_response({'ok': True, 'result': fake_result(request.match_info['method'], params)})
+
+    async def file_download(request):
+        return web.Response(body=FAKE_FILE)
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', bot_method)
+    app.router.add_get('/file/bot{token}/{path:.*}', file_download)
+    return app
+
+
+async def post_update(session, url, update, headers, attempts=60):
+    for attempt in range(attempts):
+        try:
+            async with session.post(url, json=update, headers=headers) as response:
+                if response.status != 200:
+                    print(f"   webhook answered {response.status}")
+                return
+        except aiohttp.ClientConnectionError:
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(0.5)
+
+
+async def main(args):
+    runner = web.AppRunner(create_api_app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Fake Bot API on http://{args.host}:{args.port}")
+
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+    async with aiohttp.ClientSession() as session:
+        user_id = args.user
+        for kind, value in args.steps:
+            if kind == 'user':
+                user_id = value
+                continue
+            if kind == 'text':
+                update = text_update(user_id, value)
+            elif kind == 'photo':
+                update = photo_update(user_id)
+            else:
+                update = callback_update(user_id, value)
+            print(f"<- {user_id} {kind} {value!r}")
+            await post_update(session, args.webhook, update, headers)
+            await asyncio.sleep(args.delay)
+
+    if args.serve:
+        print("Serving Bot API until interrupted")
+        await asyncio.Event().wait()
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API and update sender")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081, help="port for the fake Bot API")
+    parser.add_argument("--webhook", default="http://127.0.0.1:8443/telegram", help="bot's webhook URL")
+    parser.add_argument("--secret", default=None, help="WEBHOOK_SECRET of the bot")
+    parser.add_argument("--user", type=int, default=1000, help="user id the updates come from")
+    parser.add_argument("--delay", type=float, default=0.5, help="seconds to wait after each update")
+    parser.add_argument("--text", dest="steps", action="append", type=lambda value: ('text', value), default=[])
+    parser.add_argument("--callback", dest="steps", action="append", type=lambda value: ('callback', value))
+    parser.add_argument("--as", dest="steps", action="append", type=lambda value: ('user', int(value)),
+                        help="send the following updates from this user id")
+    parser.add_argument("--photo", dest="steps", action="append_const", const=('photo', None),
+                        help="send a photo message")
+    parser.add_argument("--serve", action="store_true", help="keep the Bot API running after the updates")
+    asyncio.run(main(parser.parse_args()))
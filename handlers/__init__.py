@@ -0,0 +1,12 @@
+# The bot's handlers, split by feature:
+#   state          shared services (outbound queue, photos, stats, ...) and the storage
+#   listings       in-memory listings index, expiry and cluster events
+#   render         main keyboard and helpers for captions and photos
+#   browse, sell, account, notifications   the handlers themselves
+#   routes         commands, menu, inline button routes and add_handlers()
+#   lifecycle      startup/shutdown hooks and periodic jobs
+# Importing the package has no side effects: the storage is opened by init_storage() and
+# telegram.ext is only imported when an Application is set up, see ru.py.
+
+from . import routes, lifecycle
+from .state import init_storage
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import functools
+from typing import TYPE_CHECKING
+
+import telegram
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+
+from . import state
+from .state import CATEGORIES, CALLBACKS, OUTBOUND, STATS, EVENTS, user_lock, load_user_data, \
+    load_purchased_items, release_photo
+from .listings import SELLER_INDEX, ITEM_INDEX, unindex_item
+from .render import CARD_CACHE_SIZE, main_keyboard, markdown, reply_item_photo, NO_PHOTO_NOTE
+
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
+
+# The user's own listings, purchases and profile
+
+@functools.lru_cache(maxsize=CARD_CACHE_SIZE)
+def own_item_card(item_id, name, price):
+    text = f"*{markdown(name)}*\nЦена: {markdown(price)} ₽"
+    reply_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("🗑️ Удалить", callback_data=CALLBACKS.pack(delete_item, item_id)),
+        InlineKeyboardButton("◀️ Назад", callback_data=CALLBACKS.pack(handle_my_items_text))
+    ]])
+    return text, reply_markup
+
+@functools.lru_cache(maxsize=CARD_CACHE_SIZE)
+def purchased_card(name, price):
+    return f"*{markdown(name)}*\nЦена: {markdown(price)} ₽"
+
+@functools.cache
+def back_to_my_items_keyboard():
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("◀️ Назад", callback_data=CALLBACKS.pack(handle_my_items_text))
+    ]])
+
+@functools.cache
+def item_deleted_keyboard():
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("◀️ Назад к Моим Товарам", callback_data=CALLBACKS.pack(handle_my_items_text))
+    ]])
+
+# My Items handlers
+async def handle_my_items_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id  # Use effective_user to get the user ID
+    user_items = await load_user_data(user_id)
+
+    if not user_items:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.effective_chat.send_message,
+            "Вы еще не добавили ни одного товара.",
+            reply_markup=main_keyboard()
+        )
+        return
+
+    # Only categories in CATEGORIES can have a button
+    categories = [category for category in CATEGORIES if any(item['category'] == category for item in user_items)]
+    keyboard = [
+        [InlineKeyboardButton(category, callback_data=CALLBACKS.pack(show_my_items_in_category, CATEGORIES.index(category)))]
+        for category in categories
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await OUTBOUND.send(
+        update.effective_chat.id, update.effective_chat.send_message,
+        "Выберите категорию, чтобы просмотреть ваши товары:",
+        reply_markup=reply_markup
+    )
+
+async def show_my_items_in_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category):
+    query = update.callback_query
+    user_id = query.from_user.id
+
+    user_items = [
+        item for item in SELLER_INDEX.get(str(user_id), [])
+        if item['category'] == category
+    ]
+
+    if not user_items:
+        await OUTBOUND.send(
+            query.message.chat_id, query.edit_message_text,
+            f"Товары в категории {category} не найдены.",
+            reply_markup=back_to_my_items_keyboard()
+        )
+        return
+
+    await OUTBOUND.send(query.message.chat_id, query.edit_message_text, f"Ваши товары в категории {category}:")
+
+    for item in user_items:
+        text, reply_markup = own_item_card(item['id'], item['name'], item['price'])
+
+        sent = await reply_item_photo(
+            query.message, item, thumbnail=True, caption=text, reply_markup=reply_markup, parse_mode='MarkdownV2'
+        )
+        if not sent:
+            await OUTBOUND.send(
+                query.message.chat_id, query.message.reply_text,
+                text + NO_PHOTO_NOTE,
+                reply_markup=reply_markup,
+                parse_mode='MarkdownV2'
+            )
+
+# Profile handlers
+async def handle_profile_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id  # Also opened from a callback button
+    user_stats = STATS.user(user_id)
+
+    profile_text = (
+        "*Ваш профиль*\n"
+        f"Активные объявления: {user_stats['listings']}\n"
+        f"Купленные товары: {user_stats['purchased']}\n"
+        f"Потрачено: {user_stats['spent']:.2f} ₽\n"
+    )
+
+    await OUTBOUND.send(
+        update.effective_chat.id, update.effective_chat.send_message,
+        profile_text,
+        parse_mode='Markdown',
+        reply_markup=main_keyboard()
+    )
+
+# Purchased items handlers
+async def handle_purchased_items_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id  # Get user ID reliably
+    purchased_items = await load_purchased_items(user_id)
+
+    # Determine whether the function was called from a message or callback query
+    message = update.message if update.message else update.callback_query.message
+
+    if not purchased_items:
+        await OUTBOUND.send(
+            message.chat_id, message.reply_text,
+            "Вы еще не купили ни одного товара.",
+            reply_markup=main_keyboard()
+        )
+        return
+
+    # Send an initial message about purchased items
+    await OUTBOUND.send(message.chat_id, message.reply_text, "Ваши купленные товары:")
+
+    # Display each purchased item with text or photo
+    for item in purchased_items:
+        text = purchased_card(item['name'], item['price'])
+
+        sent = await reply_item_photo(
+            message, item, thumbnail=True, buyer_id=user_id, caption=text, parse_mode='MarkdownV2'
+        )
+        if not sent:
+            await OUTBOUND.send(
+                message.chat_id, message.reply_text,
+                text + NO_PHOTO_NOTE,
+                parse_mode='MarkdownV2'
+            )
+
+# Delete item handler
+async def delete_item(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id):
+    query = update.callback_query
+    user_id = query.from_user.id
+
+    async with user_lock(user_id):
+        item_to_delete = ITEM_INDEX.get(item_id)
+        found = item_to_delete is not None and item_to_delete['seller_id'] == str(user_id)
+        if found:
+            # Remove item from the index and user's listings
+            unindex_item(item_to_delete)
+            found = await state.STORAGE.remove_item(user_id, item_id)
+        if found:
+            # Another worker process may have sold it already; then the photo is the buyer's
+            await release_photo(item_to_delete)
+            STATS.listing_removed(user_id, item_to_delete)
+            EVENTS.publish({'op': 'remove', 'item_ids': [item_id], 'expired': False})
+
+    if not found:
+        await OUTBOUND.send(
+            query.message.chat_id, query.edit_message_text,
+            "Товар не найден.",
+            reply_markup=back_to_my_items_keyboard()
+        )
+        return
+
+    # Check if the message contains text or a photo and handle accordingly
+    try:
+        await OUTBOUND.send(
+            query.message.chat_id, query.edit_message_text,
+            "✅ Товар успешно удален!",
+            reply_markup=item_deleted_keyboard()
+        )
+    except telegram.error.BadRequest:
+        # If there's no text to edit, send a new message
+        await OUTBOUND.send(
+            query.message.chat_id, query.message.reply_text,
+            "✅ Товар успешно удален!",
+            reply_markup=item_deleted_keyboard()
+        )
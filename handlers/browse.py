@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import os
+import re
+import functools
+from typing import TYPE_CHECKING
+
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+
+from .state import CATEGORIES, CALLBACKS, OUTBOUND, STATS, PURCHASES, NOTIFIER, EVENTS, user_lock
+from .listings import ITEM_INDEX, SEARCH_INDEX, index_item, unindex_item, category_view
+from .render import CARD_CACHE_SIZE, main_keyboard, markdown, reply_item_photo, NO_PHOTO_NOTE
+from .account import handle_purchased_items_text
+
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
+
+# Browsing, searching and buying listings
+
+# Items per page when browsing a category
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "10"))
+
+PRICE_RANGE_RE = re.compile(r'(\d+(?:[.,]\d+)?)?-(\d+(?:[.,]\d+)?)?')
+
+@functools.lru_cache(maxsize=CARD_CACHE_SIZE)
+def item_button(number, item_id):
+    return InlineKeyboardButton(str(number), callback_data=CALLBACKS.pack(show_item_card, item_id))
+
+@functools.lru_cache(maxsize=CARD_CACHE_SIZE)
+def listing_card(item_id, name, price, contact_number, category):
+    text = f"*{markdown(name)}*\nЦена: {markdown(price)} ₽\nКонтакт: {markdown(contact_number)}"
+    reply_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("🛒 Купить сейчас", callback_data=CALLBACKS.pack(confirm_purchase, item_id)),
+        InlineKeyboardButton("◀️ Назад", callback_data=CALLBACKS.pack(
+            show_items_in_category, CATEGORIES.index(category)))
+    ]])
+    return text, reply_markup
+
+@functools.lru_cache(maxsize=CARD_CACHE_SIZE)
+def confirm_purchase_keyboard(item_id):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Подтвердить", callback_data=CALLBACKS.pack(handle_buy_item, item_id)),
+        InlineKeyboardButton("❌ Отменить", callback_data=CALLBACKS.pack(handle_buy))
+    ]])
+
+@functools.cache
+def buy_categories_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(category, callback_data=CALLBACKS.pack(show_items_in_category, index))]
+        for index, category in enumerate(CATEGORIES)
+    ])
+
+@functools.cache
+def back_to_categories_button():
+    return InlineKeyboardButton("◀️ Назад к категориям", callback_data=CALLBACKS.pack(handle_buy))
+
+@functools.cache
+def back_to_categories_keyboard():
+    return InlineKeyboardMarkup([[back_to_categories_button()]])
+
+@functools.cache
+def purchase_done_keyboard():
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("Просмотреть купленные товары", callback_data=CALLBACKS.pack(handle_purchased_items_text)),
+        InlineKeyboardButton("Продолжить покупки", callback_data=CALLBACKS.pack(handle_buy))
+    ]])
+
+def item_list(items, first_number):
+    # Numbered text lines and rows of matching buttons that open each item's card
+    lines = []
+    buttons = []
+    for number, item in enumerate(items, start=first_number):
+        lines.append(f"{number}. {item['name']} — {item['price']} ₽")
+        buttons.append(item_button(number, item['id']))
+    return lines, [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+
+# Buy flow function
+async def handle_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    reply_markup = buy_categories_keyboard()
+
+    # Check if callback_query and message exist and have text
+    if update.callback_query and update.callback_query.message and update.callback_query.message.text:
+        # Edit the existing message text if it contains text
+        await OUTBOUND.send(
+            update.effective_chat.id, update.callback_query.edit_message_text,
+            "Выберите категорию для просмотра:",
+            reply_markup=reply_markup
+        )
+    else:
+        # Send a new message if there is no text to edit or callback_query is None
+        await OUTBOUND.send(
+            update.effective_chat.id, update.effective_chat.send_message,
+            "Выберите категорию для просмотра:",
+            reply_markup=reply_markup
+        )
+
+async def show_items_in_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category):
+    await show_category_page(update.callback_query, category, 0)
+
+async def show_category_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, category, page):
+    await show_category_page(update.callback_query, category, page)
+
+async def show_category_page(query, category, page):
+    # One message per page: a numbered list with a button per item and prev/next buttons
+    items = category_view(category)
+
+    if not items:
+        text = f"Товары в категории {category} не найдены."
+        reply_markup = back_to_categories_keyboard()
+    else:
+        page_count = (len(items) + PAGE_SIZE - 1) // PAGE_SIZE
+        page = min(max(page, 0), page_count - 1)
+        page_items = items[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+
+        lines, keyboard = item_list(page_items, page * PAGE_SIZE + 1)
+        text = "\n".join([f"{category} — страница {page + 1} из {page_count}", ""] + lines)
+
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("◀️", callback_data=CALLBACKS.pack(show_category_page_callback, CATEGORIES.index(category), page - 1)))
+        if page < page_count - 1:
+            navigation.append(InlineKeyboardButton("▶️", callback_data=CALLBACKS.pack(show_category_page_callback, CATEGORIES.index(category), page + 1)))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([back_to_categories_button()])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+    # A photo card can't be edited into a text message, so send a new one
+    if query.message.text:
+        await OUTBOUND.send(query.message.chat_id, query.edit_message_text, text, reply_markup=reply_markup)
+    else:
+        await OUTBOUND.send(query.message.chat_id, query.message.reply_text, text, reply_markup=reply_markup)
+
+async def show_item_card(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id):
+    query = update.callback_query
+    item = ITEM_INDEX.get(item_id)
+
+    if not item:
+        await OUTBOUND.send(
+            query.message.chat_id, query.message.reply_text,
+            "Извините, этот товар больше недоступен.",
+            reply_markup=back_to_categories_keyboard()
+        )
+        return
+
+    text, reply_markup = listing_card(
+        item['id'], item['name'], item['price'], item.get('contact_number', 'Не указан'), item['category']
+    )
+
+    sent = await reply_item_photo(
+        query.message, item, caption=text, reply_markup=reply_markup, parse_mode='MarkdownV2'
+    )
+    if not sent:
+        await OUTBOUND.send(
+            query.message.chat_id, query.message.reply_text,
+            text + NO_PHOTO_NOTE,
+            reply_markup=reply_markup,
+            parse_mode='MarkdownV2'
+        )
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /search <query> [min-max], e.g. /search стол 500-3000 or /search 100-
+    words = list(context.args)
+    min_price = max_price = None
+    if words:
+        price_range = PRICE_RANGE_RE.fullmatch(words[-1])
+        if price_range and words[-1] != '-':
+            words.pop()
+            low, high = price_range.groups()
+            min_price = float(low.replace(',', '.')) if low else None
+            max_price = float(high.replace(',', '.')) if high else None
+
+    if not words and min_price is None and max_price is None:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Использование: /search <запрос> [мин-макс]\nНапример: /search стол 500-3000",
+            reply_markup=main_keyboard()
+        )
+        return
+
+    results = SEARCH_INDEX.search(" ".join(words), min_price, max_price)
+    if not results:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "По вашему запросу ничего не найдено.",
+            reply_markup=main_keyboard()
+        )
+        return
+
+    lines, keyboard = item_list(results[:PAGE_SIZE], 1)
+    header = f"Найдено товаров: {len(results)}"
+    if len(results) > PAGE_SIZE:
+        header += f" (показаны первые {PAGE_SIZE})"
+    await OUTBOUND.send(
+        update.effective_chat.id, update.message.reply_text,
+        "\n".join([header, ""] + lines),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# Purchase flow
+async def confirm_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id):
+    query = update.callback_query
+    reply_markup = confirm_purchase_keyboard(item_id)
+
+    # Check if the callback query message has text or is a photo
+    if query.message.text:
+        # Edit the existing message text if it contains text
+        await OUTBOUND.send(
+            query.message.chat_id, query.edit_message_text,
+            "Вы уверены, что хотите купить этот товар?",
+            reply_markup=reply_markup
+        )
+    else:
+        # Send a new message if there is no text to edit
+        await OUTBOUND.send(
+            query.message.chat_id, query.message.reply_text,
+            "Вы уверены, что хотите купить этот товар?",
+            reply_markup=reply_markup
+        )
+
+async def handle_buy_item(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id):
+    query = update.callback_query
+    user_id = query.from_user.id
+    found_item = ITEM_INDEX.get(item_id)
+
+    if found_item:
+        # Re-check under the seller's lock: the seller may be deleting it right now.
+        # A reserved item leaves the listings at once, so nobody else can buy, delete
+        # or expire it while the purchase is being written.
+        async with user_lock(found_item['seller_id']):
+            if ITEM_INDEX.get(item_id) is found_item and PURCHASES.reserve(item_id):
+                unindex_item(found_item)
+            else:
+                found_item = None
+    if found_item:
+        try:
+            sold = await PURCHASES.commit(user_id, found_item)
+        except Exception:
+            # Nothing was written: put the item back on sale. Its expiry heap entry is
+            # still there, so it is only indexed again.
+            async with user_lock(found_item['seller_id']):
+                index_item(found_item['seller_id'], found_item)
+            raise
+        if sold:
+            # The photo is not released: the buyer's purchase now holds its reference
+            STATS.purchased(user_id, found_item)
+            EVENTS.publish({'op': 'purchase', 'buyer_id': user_id, 'item': found_item})
+            NOTIFIER.notify(int(found_item['seller_id']),
+                            f"🎉 Ваш товар «{found_item['name']}» купили за {found_item['price']} ₽.")
+        else:
+            # Sold by another worker process at the same moment
+            found_item = None
+
+    if not found_item:
+        await OUTBOUND.send(
+            query.message.chat_id, query.edit_message_text,
+            "Извините, этот товар больше недоступен.",
+            reply_markup=back_to_categories_keyboard()
+        )
+        return
+
+    await OUTBOUND.send(
+        query.message.chat_id, query.edit_message_text,
+        "✅ Покупка успешно завершена! Вы можете просмотреть этот товар в разделе купленных товаров.",
+        reply_markup=purchase_done_keyboard()
+    )
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import os
+import asyncio
+import logging
+import functools
+from typing import TYPE_CHECKING
+
+import metrics
+from storage import CachedStorage
+from . import state
+from .state import OUTBOUND, DOWNLOADS, STATS, PURCHASES, SUBSCRIPTIONS, NOTIFIER, EVENTS
+from .listings import ITEM_INDEX, build_listings_index, remove_expired_items, download_listing_photo
+from .notifications import listing_notification
+
+if TYPE_CHECKING:
+    from telegram.ext import Application, ContextTypes
+
+logger = logging.getLogger(__name__)
+
+# Startup, shutdown and periodic jobs of the Application, see ru.py
+
+# Metrics HTTP server and event-loop lag watcher, started in on_startup
+METRICS_SERVER = None
+LOOP_WATCHER = None
+
+def register_gauges():
+    metrics.register_gauges(lambda: {f"bot_outbound_{key}": value for key, value in OUTBOUND.stats().items()})
+    metrics.register_gauges(lambda: {f"bot_notify_{key}": value for key, value in NOTIFIER.stats().items()})
+    # Hits, misses and evictions of the per-user cache (STORAGE_CACHE_MB)
+    if isinstance(state.STORAGE.storage, CachedStorage):
+        metrics.register_gauges(
+            lambda: {f"bot_storage_cache_{key}": value for key, value in state.STORAGE.storage.stats().items()}
+        )
+
+async def expire_items_job(context: ContextTypes.DEFAULT_TYPE):
+    await remove_expired_items()
+
+async def log_outbound_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    logger.info("Outbound queue: %s", OUTBOUND.stats())
+
+def add_jobs(application: Application):
+    # Expired listings are removed every EXPIRY_CHECK_INTERVAL seconds; under cluster.py
+    # only the primary process does it
+    if EVENTS.is_primary:
+        application.job_queue.run_repeating(
+            expire_items_job, interval=int(os.getenv("EXPIRY_CHECK_INTERVAL", "3600")), first=60
+        )
+    application.job_queue.run_repeating(log_outbound_stats_job, interval=300)
+
+async def on_startup(application: Application):
+    global METRICS_SERVER, LOOP_WATCHER
+    METRICS_SERVER = await metrics.start_metrics_server()
+    LOOP_WATCHER = asyncio.create_task(metrics.watch_event_loop())
+    await build_listings_index()
+    # With several worker processes only the primary writes the shared counters
+    STATS.persist = EVENTS.is_primary
+    await STATS.load(state.STORAGE)
+    SUBSCRIPTIONS.load(await state.STORAGE.load_state('subscriptions'))
+    NOTIFIER.start(application.bot, listing_notification)
+    DOWNLOADS.start(functools.partial(download_listing_photo, application.bot))
+    # Listings whose photo download didn't finish before the last shutdown
+    if EVENTS.is_primary:
+        for item in ITEM_INDEX.values():
+            if item.get('photo_file_id') and not item.get('photo'):
+                DOWNLOADS.submit(item['id'])
+
+async def on_shutdown(application: Application):
+    await DOWNLOADS.stop()
+    await NOTIFIER.stop()
+    await PURCHASES.flush()
+    await STATS.flush()
+    await EVENTS.close()
+    state.STORAGE.close()
+    if LOOP_WATCHER:
+        LOOP_WATCHER.cancel()
+    if METRICS_SERVER:
+        await METRICS_SERVER.cleanup()
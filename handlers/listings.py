@@ -0,0 +1,185 @@
+import uuid
+import heapq
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+
+from search import SearchIndex
+from photos import PhotoQuotaExceeded
+from . import state
+from .state import CATEGORIES, PHOTOS, STATS, SUBSCRIPTIONS, EVENTS, user_lock, save_user_data, release_photo
+
+logger = logging.getLogger(__name__)
+
+# In-memory listings index, built once at startup by build_listings_index()
+CATEGORY_INDEX = {category: [] for category in CATEGORIES}  # category -> items
+SELLER_INDEX = {}  # seller_id -> items (same dicts as in CATEGORY_INDEX)
+ITEM_INDEX = {}  # item id -> item
+SEARCH_INDEX = SearchIndex()  # name words and prices -> items, for /search
+# Min-heap of (expires_at, item id); entries of deleted items are skipped when popped
+EXPIRY_HEAP = []
+
+# Newest-first copy of each category list for paging, rebuilt lazily after a change
+CATEGORY_VIEWS = {}
+
+# Items are removed this long after listing
+ITEM_LIFETIME = timedelta(days=30)
+
+def index_item(seller_id, item):
+    item['seller_id'] = str(seller_id)
+    CATEGORY_INDEX.setdefault(item['category'], []).append(item)
+    CATEGORY_VIEWS.pop(item['category'], None)
+    SELLER_INDEX.setdefault(str(seller_id), []).append(item)
+    ITEM_INDEX[item['id']] = item
+    SEARCH_INDEX.add(item)
+
+def schedule_expiry(item):
+    # Once per listing: an item put back into the index keeps its heap entry
+    expires_at = datetime.strptime(item['created_at'], '%Y-%m-%d') + ITEM_LIFETIME
+    heapq.heappush(EXPIRY_HEAP, (expires_at, item['id']))
+
+def category_view(category):
+    view = CATEGORY_VIEWS.get(category)
+    if view is None:
+        # Reversing an ascending sort keeps same-day items newest first too
+        view = sorted(CATEGORY_INDEX.get(category, []), key=lambda item: item['created_at'])[::-1]
+        CATEGORY_VIEWS[category] = view
+    return view
+
+def unindex_item(item):
+    ITEM_INDEX.pop(item['id'], None)
+    SEARCH_INDEX.remove(item)
+    CATEGORY_VIEWS.pop(item['category'], None)
+    # Remove by identity: two listings can have equal fields
+    for items in (CATEGORY_INDEX.get(item['category'], []), SELLER_INDEX.get(item['seller_id'], [])):
+        for i, indexed in enumerate(items):
+            if indexed is item:
+                del items[i]
+                break
+
+async def build_listings_index():
+    for items in CATEGORY_INDEX.values():
+        items.clear()
+    SELLER_INDEX.clear()
+    ITEM_INDEX.clear()
+    EXPIRY_HEAP.clear()
+    CATEGORY_VIEWS.clear()
+    SEARCH_INDEX.clear()
+    listings = await state.STORAGE.run(list, state.STORAGE.storage.all_items())
+    # Buttons refer to categories by position in CATEGORIES, so every stored listing's
+    # category has to be there; refuse to start rather than fail on its buttons later
+    unknown = {}
+    for _, item in listings:
+        if item['category'] not in CATEGORIES:
+            unknown[item['category']] = unknown.get(item['category'], 0) + 1
+    if unknown:
+        raise ValueError("Stored listings have categories missing from CATEGORIES (add them back at the end): "
+                         + ", ".join(f"{category} ({count} listings)" for category, count in unknown.items()))
+    # Listings created before item ids existed get one now
+    sellers_without_ids = set()
+    for seller_id, item in listings:
+        if 'id' not in item:
+            item['id'] = uuid.uuid4().hex
+            sellers_without_ids.add(str(seller_id))
+        index_item(seller_id, item)
+        schedule_expiry(item)
+    for seller_id in sellers_without_ids:
+        await save_user_data(seller_id, SELLER_INDEX[seller_id])
+    # Purchases keep the photo of the listing they were made from; the storage counts them
+    # without reading the purchases
+    photo_refs = Counter(await state.STORAGE.purchased_photos())
+    photo_refs.update(item['photo_hash'] for item in ITEM_INDEX.values() if item.get('photo_hash'))
+    await state.STORAGE.run(PHOTOS.load, photo_refs.elements())
+    logger.info("Listings index built: %d sellers, %d items",
+                len(SELLER_INDEX), sum(len(items) for items in SELLER_INDEX.values()))
+
+async def remove_expired_items():
+    # Pop only the items that have expired and group them by seller
+    current_time = datetime.now()
+    expired_by_seller = {}
+    while EXPIRY_HEAP and EXPIRY_HEAP[0][0] < current_time:
+        _, item_id = heapq.heappop(EXPIRY_HEAP)
+        item = ITEM_INDEX.get(item_id)
+        if item is None:
+            continue
+        expired_by_seller.setdefault(item['seller_id'], []).append(item)
+
+    reclaimed_bytes = 0
+    for seller_id, items in expired_by_seller.items():
+        async with user_lock(seller_id):
+            # The seller may have deleted some of them while we waited for the lock
+            items[:] = [item for item in items if ITEM_INDEX.get(item['id']) is item]
+            for item in items:
+                unindex_item(item)
+            if items:
+                # Items another worker process sold meanwhile are left to the purchase
+                removed = set(await state.STORAGE.remove_items(seller_id, [item['id'] for item in items]))
+                items[:] = [item for item in items if item['id'] in removed]
+                for item in items:
+                    STATS.listing_removed(seller_id, item, expired=True)
+                    reclaimed_bytes += await release_photo(item)
+                if items:
+                    EVENTS.publish({'op': 'remove', 'item_ids': [item['id'] for item in items], 'expired': True})
+
+    logger.info("Expired %d items from %d sellers, reclaimed %d bytes",
+                sum(len(items) for items in expired_by_seller.values()), len(expired_by_seller), reclaimed_bytes)
+
+def apply_cluster_events(events):
+    # Mirror listing changes made by another worker process (see cluster.py). The storage
+    # and the photo files were already changed by that process; only memory is updated here.
+    for event in events:
+        if event['op'] == 'add':
+            item = event['item']
+            if item['id'] not in ITEM_INDEX:
+                index_item(event['seller_id'], item)
+                schedule_expiry(item)
+                STATS.listing_added(event['seller_id'], item)
+                if item.get('photo_hash'):
+                    PHOTOS.adopt(item['photo_hash'])
+        elif event['op'] == 'update':
+            item = ITEM_INDEX.get(event['item_id'])
+            if item is not None:
+                if event['fields'].get('photo_hash') and not item.get('photo_hash'):
+                    PHOTOS.adopt(event['fields']['photo_hash'])
+                item.update(event['fields'])
+        elif event['op'] == 'remove':
+            for item_id in event['item_ids']:
+                item = ITEM_INDEX.get(item_id)
+                if item is not None:
+                    unindex_item(item)
+                    STATS.listing_removed(item['seller_id'], item, expired=event['expired'])
+                    if item.get('photo_hash'):
+                        PHOTOS.release(item['photo_hash'], delete=False)
+        elif event['op'] == 'purchase':
+            item = ITEM_INDEX.get(event['item']['id'])
+            if item is not None:
+                # Its photo reference passes to the purchase
+                unindex_item(item)
+            # Counted even if the item is no longer indexed here: a delete or expiry in this
+            # process that lost the race to the sale removed nothing and counted nothing
+            STATS.purchased(event['buyer_id'], event['item'])
+        elif event['op'] == 'subscriptions':
+            SUBSCRIPTIONS.set(event['user_id'], event['categories'])
+
+async def download_listing_photo(bot, item_id):
+    # Runs in a DOWNLOADS worker: fetch the listing's photo and keep a local copy
+    item = ITEM_INDEX.get(item_id)
+    if item is None or item.get('photo'):
+        return
+    photo_file = await bot.get_file(item['photo_file_id'])
+    photo_bytes = await photo_file.download_as_bytearray()
+    try:
+        stored_photo = await state.STORAGE.run(PHOTOS.put, bytes(photo_bytes))
+    except PhotoQuotaExceeded as error:
+        # The listing still shows its photo through the file_id
+        logger.warning("Photo quota exceeded, not keeping a copy of item %s: %s", item_id, error)
+        return
+
+    async with user_lock(item['seller_id']):
+        if ITEM_INDEX.get(item_id) is not item:
+            # Deleted while downloading
+            await state.STORAGE.run(PHOTOS.release, stored_photo['photo_hash'])
+            return
+        item.update(stored_photo)
+        await state.STORAGE.update_item(item['seller_id'], item)
+        EVENTS.publish({'op': 'update', 'item_id': item_id, 'fields': stored_photo})
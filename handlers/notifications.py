@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING
+
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+
+from . import state
+from .state import CATEGORIES, CALLBACKS, OUTBOUND, SUBSCRIPTIONS, EVENTS
+from .listings import ITEM_INDEX
+from .render import main_keyboard
+from .browse import show_item_card
+
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
+
+# /subscribe and /unsubscribe, and the message a subscriber gets for a new listing
+
+PRICE_RE = re.compile(r'\d+(?:[.,]\d+)?')
+
+def find_category(name):
+    name = name.strip().casefold()
+    return next((category for category in CATEGORIES if category.casefold() == name), None)
+
+async def save_subscriptions(user_id, categories):
+    SUBSCRIPTIONS.set(user_id, categories)
+    await state.STORAGE.save_state('subscriptions', {str(user_id): categories or None})
+    EVENTS.publish({'op': 'subscriptions', 'user_id': user_id, 'categories': categories})
+
+def subscriptions_text(user_id):
+    categories = SUBSCRIPTIONS.get(user_id)
+    if not categories:
+        return "У вас нет подписок."
+    lines = ["Ваши подписки:"]
+    for category, max_price in categories.items():
+        lines.append(f"• {category}" + (f" — до {max_price} ₽" if max_price is not None else ""))
+    return "\n".join(lines)
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /subscribe <category> [max price], e.g. /subscribe Мебель 3000
+    user_id = update.effective_user.id
+    words = list(context.args)
+    max_price = None
+    if len(words) > 1 and PRICE_RE.fullmatch(words[-1]):
+        max_price = float(words.pop().replace(',', '.'))
+    category = find_category(" ".join(words))
+
+    if category is None:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Использование: /subscribe <категория> [макс. цена]\nНапример: /subscribe Мебель 3000\n\n"
+            "Категории: " + ", ".join(CATEGORIES) + "\n\n" + subscriptions_text(user_id),
+            reply_markup=main_keyboard()
+        )
+        return
+
+    categories = SUBSCRIPTIONS.get(user_id)
+    categories[category] = max_price
+    await save_subscriptions(user_id, categories)
+    await OUTBOUND.send(
+        update.effective_chat.id, update.message.reply_text,
+        f"Готово! Новые товары в категории {category}" + (f" до {max_price} ₽" if max_price is not None else "")
+        + " будут приходить вам сюда.",
+        reply_markup=main_keyboard()
+    )
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /unsubscribe [category]; without a category removes all subscriptions
+    user_id = update.effective_user.id
+    categories = SUBSCRIPTIONS.get(user_id)
+    if context.args:
+        category = find_category(" ".join(context.args))
+        if category not in categories:
+            await OUTBOUND.send(
+                update.effective_chat.id, update.message.reply_text,
+                subscriptions_text(user_id),
+                reply_markup=main_keyboard()
+            )
+            return
+        del categories[category]
+    else:
+        categories = {}
+    await save_subscriptions(user_id, categories)
+    await OUTBOUND.send(
+        update.effective_chat.id, update.message.reply_text,
+        "Подписка отменена.\n\n" + subscriptions_text(user_id),
+        reply_markup=main_keyboard()
+    )
+
+def listing_notification(item):
+    # None if the listing was sold or deleted before its turn in the notification queue
+    if ITEM_INDEX.get(item['id']) is not item:
+        return None
+    text = f"🔔 Новый товар в категории {item['category']}:\n{item['name']} — {item['price']} ₽"
+    reply_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("Посмотреть", callback_data=CALLBACKS.pack(show_item_card, item['id']))
+    ]])
+    return text, {'reply_markup': reply_markup}
@@ -0,0 +1,77 @@
+import os
+import logging
+import functools
+
+import telegram
+from telegram import ReplyKeyboardMarkup, KeyboardButton
+from telegram.helpers import escape_markdown
+
+from . import state
+from .state import OUTBOUND, EVENTS, user_lock, read_file
+from .listings import ITEM_INDEX
+
+logger = logging.getLogger(__name__)
+
+# Rendered captions and buttons are cached by the item fields they show, so a changed
+# item gets a new entry and old ones fall out of the LRU. Telegram markup objects are
+# immutable and can be shared between messages. Keyboards that never change are built
+# on first use, once the routes are registered.
+CARD_CACHE_SIZE = int(os.getenv("CARD_CACHE_SIZE", "4096"))
+
+# Persistent keyboard
+@functools.cache
+def main_keyboard():
+    return ReplyKeyboardMarkup(
+        [
+            [KeyboardButton("🛒 Купить товары"), KeyboardButton("➕ Продать товар")],
+            [KeyboardButton("📦 Мои товары"), KeyboardButton("🛍 Купленные товары")],
+            [KeyboardButton("👤 Профиль"), KeyboardButton("❓ Помощь")]
+        ],
+        resize_keyboard=True
+    )
+
+def markdown(text):
+    # Any value shown in a MarkdownV2 caption, user-supplied or not: V2 also reserves
+    # characters such as . ( ) -, and legacy Markdown can't escape inside *bold*
+    return escape_markdown(str(text), version=2)
+
+# Added to a card caption sent as text because there is no photo
+NO_PHOTO_NOTE = "\n\n" + markdown("(Фото не доступно)")
+
+def file_id_rejected(error):
+    # "Wrong file identifier/HTTP URL specified", "File reference expired", ...; other
+    # BadRequests, e.g. a caption Telegram can't parse, would fail the upload as well
+    message = error.message.lower()
+    return "file identifier" in message or "file reference" in message
+
+async def reply_item_photo(message, item, thumbnail=False, buyer_id=None, **kwargs):
+    # Send the photo by its Telegram file_id; upload the local file only if there is
+    # no file_id yet or Telegram rejects it. Returns None if there is no photo at all.
+    # List views pass thumbnail=True to send the small version; purchases pass the
+    # buyer's id so the new file_id is stored on the purchase.
+    file_id_key, path_key = ('thumb_file_id', 'thumb') if thumbnail else ('photo_file_id', 'photo')
+    file_id = item.get(file_id_key)
+    if file_id:
+        try:
+            return await OUTBOUND.send(message.chat_id, message.reply_photo, photo=file_id, **kwargs)
+        except telegram.error.BadRequest as error:
+            if not file_id_rejected(error):
+                raise
+            logger.warning("Cached file_id rejected for item %s, uploading local file", item.get('id'))
+
+    photo_path = item.get(path_key) or item.get("photo")
+    photo_bytes = await state.STORAGE.run(read_file, photo_path) if photo_path else None
+    if photo_bytes is None:
+        return None
+    sent = await OUTBOUND.send(message.chat_id, message.reply_photo, photo=photo_bytes, **kwargs)
+
+    # Remember the new file_id so later views send a reference instead of the bytes
+    item[file_id_key] = sent.photo[-1].file_id
+    if buyer_id is not None:
+        await state.STORAGE.update_purchase(buyer_id, item)
+    elif ITEM_INDEX.get(item.get('id')) is item:
+        async with user_lock(item['seller_id']):
+            if ITEM_INDEX.get(item['id']) is item:
+                await state.STORAGE.update_item(item['seller_id'], item)
+                EVENTS.publish({'op': 'update', 'item_id': item['id'], 'fields': {file_id_key: item[file_id_key]}})
+    return sent
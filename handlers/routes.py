@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from telegram import Update
+
+import metrics
+from metrics import instrument
+from .state import CATEGORIES, CALLBACKS, OUTBOUND, STATS, ADMIN_IDS
+from .render import main_keyboard
+from .browse import handle_buy, show_items_in_category, show_category_page_callback, show_item_card, \
+    search_command, confirm_purchase, handle_buy_item
+from .sell import handle_sell_start, handle_sell_category, handle_product_name, handle_product_price, \
+    handle_product_contact, handle_product_photo, handle_unsupported_file
+from .account import handle_my_items_text, show_my_items_in_category, handle_profile_text, \
+    handle_purchased_items_text, delete_item
+from .notifications import subscribe_command, unsubscribe_command
+
+if TYPE_CHECKING:
+    from telegram.ext import Application, ContextTypes
+
+# Commands, the main menu, and the dispatch of inline buttons and text messages
+
+# Command handlers
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await OUTBOUND.send(
+        update.effective_chat.id, update.message.reply_text,
+        "Добро пожаловать на рынок! Пожалуйста, используйте меню ниже для навигации:",
+        reply_markup=main_keyboard()
+    )
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    help_text = """
+Доступные команды:
+/start - Открыть главное меню
+/help - Показать это сообщение помощи
+/search <запрос> [мин-макс] - Найти товары по названию и цене
+/subscribe <категория> [макс. цена] - Получать новые товары категории
+/unsubscribe [категория] - Отписаться от категории или от всех
+
+Вы также можете использовать постоянные кнопки меню ниже для навигации.
+"""
+    await OUTBOUND.send(update.effective_chat.id, update.message.reply_text, help_text, reply_markup=main_keyboard())
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    totals = STATS.totals()
+    lines = [
+        "Статистика",
+        f"Пользователи: {totals['users']}",
+        f"Активные объявления: {totals['listings']}",
+        f"Продано: {totals['sold']} на {totals['revenue']:.2f} ₽",
+        "",
+    ]
+    for category, category_stats in STATS.categories.items():
+        lines.append(f"{category}: объявлений {category_stats['listings']}, "
+                     f"продано {category_stats['sold']} на {category_stats['revenue']:.2f} ₽")
+    await OUTBOUND.send(update.effective_chat.id, update.message.reply_text, "\n".join(lines))
+
+# Utility function to clear user state
+def clear_user_state(context):
+    if 'add_product_step' in context.user_data:
+        del context.user_data['add_product_step']
+    if 'current_product' in context.user_data:
+        del context.user_data['current_product']
+
+async def handle_menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Clear user state at the start of every new command
+    clear_user_state(context)
+    text = update.message.text
+
+    command_map = {
+        "🛒 Купить товары": handle_buy,
+        "➕ Продать товар": handle_sell_start,
+        "📦 Мои товары": handle_my_items_text,
+        "🛍 Купленные товары": handle_purchased_items_text,
+        "👤 Профиль": handle_profile_text,
+        "❓ Помощь": help_command
+    }
+
+    handler = command_map.get(text)
+    if handler:
+        await handler(update, context)
+    else:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Пожалуйста, используйте кнопки меню для навигации.",
+            reply_markup=main_keyboard()
+        )
+
+def category_arg(index):
+    # Index into CATEGORIES; isdigit() also keeps out negative indexes
+    if not index.isdigit():
+        raise ValueError(f"Bad category index {index!r}")
+    return CATEGORIES[int(index)]
+
+# Inline button routes, see router.py. Changing a code or its arguments needs a new
+# version, so buttons in old messages are answered as stale instead of misrouted.
+CALLBACKS.add('B', handle_buy)
+CALLBACKS.add('S', handle_sell_start)
+CALLBACKS.add('M', handle_my_items_text)
+CALLBACKS.add('P', handle_purchased_items_text)
+CALLBACKS.add('U', handle_profile_text)
+CALLBACKS.add('c', show_items_in_category, category_arg)
+CALLBACKS.add('p', show_category_page_callback, category_arg, int)
+CALLBACKS.add('i', show_item_card, str)
+CALLBACKS.add('s', handle_sell_category, category_arg)
+CALLBACKS.add('cb', confirm_purchase, str)
+CALLBACKS.add('b', handle_buy_item, str)
+CALLBACKS.add('mc', show_my_items_in_category, category_arg)
+CALLBACKS.add('d', delete_item, str)
+
+# Main callback query handler
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    route = CALLBACKS.resolve(query.data)
+    if route is None:
+        await query.answer("Эта кнопка устарела. Пожалуйста, откройте меню заново.")
+        return
+    await query.answer()
+
+    handler, args = route
+    with metrics.timer(metrics.CALLBACK_SECONDS, handler.__name__):
+        await handler(update, context, *args)
+
+# Text message handler
+async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if 'add_product_step' in context.user_data:
+        if context.user_data['add_product_step'] == 'ask_name':
+            await handle_product_name(update, context)
+        elif context.user_data['add_product_step'] == 'ask_price':
+            await handle_product_price(update, context)
+        elif context.user_data['add_product_step'] == 'ask_contact':
+            await handle_product_contact(update, context)
+        elif context.user_data['add_product_step'] == 'ask_photo':
+            await handle_product_photo(update, context)
+    else:
+        await handle_menu_command(update, context)
+
+def add_handlers(application: Application):
+    # telegram.ext is only needed once there is an Application to register with
+    from telegram.ext import CommandHandler, CallbackQueryHandler, MessageHandler, filters
+
+    # instrument() collects timings and disk reads for /metrics
+    application.add_handler(CommandHandler("start", instrument(start)))
+    application.add_handler(CommandHandler("help", instrument(help_command)))
+    application.add_handler(CommandHandler("search", instrument(search_command)))
+    application.add_handler(CommandHandler("stats", instrument(stats_command)))
+    application.add_handler(CommandHandler("subscribe", instrument(subscribe_command)))
+    application.add_handler(CommandHandler("unsubscribe", instrument(unsubscribe_command)))
+    application.add_handler(CallbackQueryHandler(instrument(button_handler)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument(text_handler)))
+    application.add_handler(MessageHandler(filters.PHOTO, instrument(handle_product_photo)))
+    application.add_handler(MessageHandler(filters.ATTACHMENT, instrument(handle_unsupported_file)))  # Videos and documents
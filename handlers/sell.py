@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import re
+import uuid
+import functools
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+
+from . import state
+from .state import CATEGORIES, CALLBACKS, OUTBOUND, STATS, DOWNLOADS, NOTIFIER, EVENTS, user_lock
+from .listings import index_item, schedule_expiry
+from .render import main_keyboard
+
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
+
+# The sell flow: category, name, price, contact number and photo, one message each.
+# context.user_data keeps the current step and the listing being built.
+
+@functools.cache
+def sell_categories_keyboard():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(category, callback_data=CALLBACKS.pack(handle_sell_category, index))]
+        for index, category in enumerate(CATEGORIES)
+    ])
+
+# Start the "Sell Item" process and set up context only when selected
+async def handle_sell_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Initialize the "Sell Item" process steps
+    context.user_data['add_product_step'] = 'choose_category'
+    context.user_data['current_product'] = {}
+    reply_markup = sell_categories_keyboard()
+
+    message_text = (
+        "Давайте добавим ваш товар!\n\n"
+        "1️⃣ Выберите категорию\n"
+        "2️⃣ Введите название\n"
+        "3️⃣ Установите цену\n"
+        "4️⃣ Введите контактный номер\n"
+        "5️⃣ Загрузите фото\n\n"
+        "Пожалуйста, выберите категорию:"
+    )
+
+    if update.callback_query:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.callback_query.edit_message_text,
+            message_text,
+            reply_markup=reply_markup
+        )
+    else:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            message_text,
+            reply_markup=reply_markup
+        )
+
+async def handle_sell_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category):
+    query = update.callback_query
+    context.user_data['current_product'] = {'category': category}
+    context.user_data['add_product_step'] = 'ask_name'
+    await OUTBOUND.send(
+        query.message.chat_id, query.edit_message_text,
+        "Отлично! Теперь, пожалуйста, введите название вашего товара."
+    )
+
+async def handle_product_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if 'add_product_step' not in context.user_data:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Пожалуйста, начните процесс продажи с помощью меню.",
+            reply_markup=main_keyboard()
+        )
+        return
+
+    context.user_data['current_product']['name'] = update.message.text
+    context.user_data['add_product_step'] = 'ask_price'
+    await OUTBOUND.send(
+        update.effective_chat.id, update.message.reply_text,
+        "Пожалуйста, введите цену в рублях (только цифры):"
+    )
+
+async def handle_product_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        price = float(update.message.text)
+        context.user_data['current_product']['price'] = price
+        context.user_data['add_product_step'] = 'ask_contact'  # Set the next step to ask for contact number
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Пожалуйста, введите ваш контактный номер, чтобы покупатели могли связаться с вами."
+        )
+    except ValueError:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Пожалуйста, введите корректную цену (только цифры)."
+        )
+
+async def handle_product_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if 'add_product_step' not in context.user_data or context.user_data['add_product_step'] != 'ask_contact':
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Пожалуйста, начните процесс продажи с помощью меню.",
+            reply_markup=main_keyboard()
+        )
+        return
+
+    contact_number = update.message.text
+
+    # Validate the contact number: only digits, between 8 and 15 characters
+    if not re.fullmatch(r'\d{8,15}', contact_number):
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Пожалуйста, введите корректный контактный номер (8–15 цифр)."
+        )
+        return
+
+    # Save the validated contact number and proceed to the next step
+    context.user_data['current_product']['contact_number'] = contact_number
+    context.user_data['add_product_step'] = 'ask_photo'  # Move to the next step
+    await OUTBOUND.send(
+        update.effective_chat.id, update.message.reply_text,
+        "Отлично! Теперь, пожалуйста, отправьте фото вашего товара."
+    )
+
+async def handle_product_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if 'add_product_step' not in context.user_data or context.user_data['add_product_step'] != 'ask_photo':
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Пожалуйста, начните процесс продажи с помощью меню.",
+            reply_markup=main_keyboard()
+        )
+        return
+
+    # Check if the message contains a photo
+    if update.message.photo:
+        # Get the highest resolution photo
+        photo = update.message.photo[-1]
+        user_id = update.message.from_user.id
+
+        # Telegram already has smaller sizes of the photo; keep one for list views
+        thumb = next((size for size in reversed(update.message.photo) if max(size.width, size.height) <= 320),
+                     update.message.photo[0])
+
+        # Save item data with the photo's file_id; the local copy is downloaded in the background
+        context.user_data['current_product'].update({
+            'id': uuid.uuid4().hex,
+            'photo_file_id': photo.file_id,
+            'thumb_file_id': thumb.file_id,
+            'created_at': datetime.now().strftime('%Y-%m-%d')
+        })
+
+        # Store item data in user’s file and the listings index
+        async with user_lock(user_id):
+            index_item(user_id, context.user_data['current_product'])
+            schedule_expiry(context.user_data['current_product'])
+            await state.STORAGE.add_item(user_id, context.user_data['current_product'])
+            STATS.listing_added(user_id, context.user_data['current_product'])
+            EVENTS.publish({'op': 'add', 'seller_id': user_id, 'item': context.user_data['current_product']})
+        DOWNLOADS.submit(context.user_data['current_product']['id'])
+        NOTIFIER.listing_added(context.user_data['current_product'])
+
+        # Clear context and confirm
+        context.user_data.clear()
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "✅ Ваш товар успешно добавлен!",
+            reply_markup=main_keyboard()
+        )
+    elif update.message.video or update.message.document:
+        # Handle unsupported file types
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Неподдерживаемый тип файла. Пожалуйста, загрузите фото (JPEG или PNG)."
+        )
+    else:
+        # In case no file or unsupported file type is sent
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Пожалуйста, загрузите фото для добавления товара."
+        )
+
+async def handle_unsupported_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if 'add_product_step' in context.user_data and context.user_data['add_product_step'] == 'ask_photo':
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Неподдерживаемый тип файла. Пожалуйста, загрузите фото (JPEG или PNG)."
+        )
+    else:
+        await OUTBOUND.send(
+            update.effective_chat.id, update.message.reply_text,
+            "Пожалуйста, используйте параметры меню для продолжения."
+        )
@@ -0,0 +1,119 @@
+import os
+import asyncio
+import weakref
+
+from storage import open_storage
+from outbound import OutboundDispatcher
+from photos import PhotoStore
+from downloads import DownloadWorkers
+from stats import StatsTable
+from purchases import PurchaseEngine
+from notify import SubscriptionIndex, Notifier
+from router import CallbackRouter
+from cluster import ClusterEvents
+import metrics
+
+# Services shared by the handlers. Settings come from the environment when the package
+# is imported, so load .env first; nothing here touches the disk until init_storage().
+
+# Categories, e.g. CATEGORIES=Бытовая техника,Мебель,Одежда,Другое. Buttons refer to a
+# category by its position in this list, so add new ones at the end.
+CATEGORIES = [
+    category.strip()
+    for category in os.getenv("CATEGORIES", "Бытовая техника,Мебель,Одежда,Другое").split(",")
+    if category.strip()
+]
+
+# Display handlers send through one dispatcher that keeps to Telegram's flood limits
+OUTBOUND = OutboundDispatcher(
+    global_rate=float(os.getenv("OUTBOUND_GLOBAL_RATE", "30")),
+    chat_rate=float(os.getenv("OUTBOUND_CHAT_RATE", "1")),
+)
+
+# Listing photos, deduplicated by content; PHOTO_QUOTA_MB caps their total size
+PHOTOS = PhotoStore(os.getenv("PHOTO_DIR", "photos"), int(os.getenv("PHOTO_QUOTA_MB", "0")) * 1024 * 1024)
+
+# Listing photos are fetched from Telegram in the background, at most
+# PHOTO_DOWNLOAD_WORKERS at a time, so the sell flow doesn't wait for them
+DOWNLOADS = DownloadWorkers(int(os.getenv("PHOTO_DOWNLOAD_WORKERS", "4")))
+
+# Per-user and per-category counters for the profile and /stats, loaded at startup and
+# written every PERSISTENCE_INTERVAL seconds like the sell flows
+STATS = StatsTable(float(os.getenv("PERSISTENCE_INTERVAL", "5")))
+
+# Purchases are written in batches, one per PURCHASE_FLUSH_INTERVAL seconds at most
+PURCHASES = PurchaseEngine(float(os.getenv("PURCHASE_FLUSH_INTERVAL", "0.01")))
+
+# /subscribe: new listings are pushed to subscribers, and sellers hear about their sales,
+# by a background task sending NOTIFY_BATCH_SIZE messages at a time
+SUBSCRIPTIONS = SubscriptionIndex()
+NOTIFIER = Notifier(OUTBOUND, SUBSCRIPTIONS, int(os.getenv("NOTIFY_BATCH_SIZE", "20")))
+
+# Users allowed to run /stats, e.g. ADMIN_IDS=12345,67890
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+
+# Listing changes are sent to the other worker processes when running under cluster.py
+EVENTS = ClusterEvents.from_env()
+
+# Inline button routes, registered in routes.py
+CALLBACKS = CallbackRouter(version=1)
+
+# Listings and purchases storage (JSON files or SQLite), opened by init_storage().
+# Every call runs in the storage thread pool and must be awaited. It is replaced after
+# import, so other modules read it as state.STORAGE rather than importing the name.
+STORAGE = None
+
+
+def init_storage():
+    # Open the storage (STORAGE_BACKEND=json|sqlite); called once before the bot starts
+    global STORAGE
+    STORAGE = open_storage(asynchronous=True)
+    PURCHASES.storage = STORAGE
+    return STORAGE
+
+
+# One asyncio lock per seller: index changes and the matching storage write for a
+# seller happen under it, so e.g. a purchase and a delete of one item can't interleave
+USER_LOCKS = weakref.WeakValueDictionary()
+
+def user_lock(user_id):
+    lock = USER_LOCKS.get(str(user_id))
+    if lock is None:
+        lock = USER_LOCKS[str(user_id)] = asyncio.Lock()
+    return lock
+
+async def load_user_data(user_id):
+    return await STORAGE.load_items(user_id)
+
+async def save_user_data(user_id, data):
+    await STORAGE.save_items(user_id, data)
+
+async def load_purchased_items(user_id):
+    return await STORAGE.load_purchased(user_id)
+
+def read_file(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        metrics.record_read(len(data))
+        return data
+    except FileNotFoundError:
+        return None
+
+# Returns the number of bytes freed
+def remove_file(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+# Drop an item's reference to its photo; returns the number of bytes freed
+async def release_photo(item):
+    if item.get('photo_hash'):
+        return await STORAGE.run(PHOTOS.release, item['photo_hash'])
+    if item.get('photo'):
+        # Stored under {category}/{user_id}/ before the photo store existed
+        return await STORAGE.run(remove_file, item['photo'])
+    return 0
@@ -0,0 +1,270 @@
+import io
+import os
+import time
+import random
+import asyncio
+import logging
+import pstats
+import cProfile
+import functools
+import threading
+import contextlib
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# In-process metrics in the Prometheus text format, served on a local HTTP endpoint:
+#   METRICS_HOST / METRICS_PORT   where /metrics and /profile listen (host 127.0.0.1;
+#                                 the server is off unless METRICS_PORT is set)
+#   PROFILE_SAMPLE_RATE           share of updates run under cProfile (default 0)
+# The sample rate can be changed at runtime with POST /profile?rate=0.05; GET /profile
+# shows the collected profile. While a sampled update runs, everything else on the event
+# loop is profiled too, so the numbers are for the whole process during that update.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+BYTE_BUCKETS = (0, 1024, 16 * 1024, 128 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+
+
+def _labels(label, value):
+    return f'{{{label}="{value}"}}' if label else ""
+
+
+class Counter:
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_value, value in self.values.items():
+                lines.append(f"{self.name}{_labels(self.label, label_value)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.series = {}  # label value -> [count per bucket..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_value, series in self.series.items():
+                prefix = f'{self.label}="{label_value}",' if self.label else ""
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[-2]}')
+                lines.append(f"{self.name}_sum{_labels(self.label, label_value)} {series[-1]}")
+                lines.append(f"{self.name}_count{_labels(self.label, label_value)} {series[-2]}")
+        return lines
+
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Time spent handling an update, per handler", "handler")
+CALLBACK_SECONDS = Histogram("bot_callback_seconds", "Time spent handling a callback query, per route", "route")
+TELEGRAM_SECONDS = Histogram("bot_telegram_request_seconds", "Bot API request latency, per method", "method")
+LOOP_LAG_SECONDS = Histogram("bot_event_loop_lag_seconds", "How late the event loop woke up a sleeping task")
+UPDATE_READS = Histogram("bot_update_storage_reads", "Storage reads per update, per handler", "handler",
+                         COUNT_BUCKETS)
+UPDATE_READ_BYTES = Histogram("bot_update_storage_read_bytes", "Bytes read from storage per update, per handler",
+                              "handler", BYTE_BUCKETS)
+STORAGE_READS = Counter("bot_storage_reads_total", "Files or database rows read")
+STORAGE_READ_BYTES = Counter("bot_storage_read_bytes_total", "Bytes read from files or database rows")
+
+METRICS = [HANDLER_SECONDS, CALLBACK_SECONDS, TELEGRAM_SECONDS, LOOP_LAG_SECONDS,
+           UPDATE_READS, UPDATE_READ_BYTES, STORAGE_READS, STORAGE_READ_BYTES]
+GAUGES = []  # functions returning {metric name: value}, read on each scrape
+
+# [reads, bytes] of the update being handled; AsyncStorage copies the context into its threads
+_update_reads = contextvars.ContextVar("update_reads", default=None)
+
+
+def record_read(nbytes, reads=1):
+    STORAGE_READS.inc(amount=reads)
+    STORAGE_READ_BYTES.inc(amount=nbytes)
+    update_reads = _update_reads.get()
+    if update_reads is not None:
+        update_reads[0] += reads
+        update_reads[1] += nbytes
+
+
+def register_gauges(func):
+    GAUGES.append(func)
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for func in GAUGES:
+        for name, value in func().items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def timer(histogram, label_value=None):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(label_value, time.perf_counter() - started)
+
+
+class Profiler:
+    # Runs a random share of updates under cProfile, one at a time, and adds them up
+    def __init__(self, rate=0.0):
+        self.rate = rate
+        self.active = False
+        self.stats = None
+        self.samples = 0
+
+    def set_rate(self, rate):
+        self.rate = rate
+        if rate:
+            self.stats = None
+            self.samples = 0
+
+    def start(self):
+        if not self.rate or self.active or random.random() >= self.rate:
+            return None
+        self.active = True
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile):
+        if profile is None:
+            return
+        profile.disable()
+        self.active = False
+        self.samples += 1
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def report(self, limit=40):
+        if self.stats is None:
+            return f"No samples yet (rate {self.rate})\n"
+        out = io.StringIO()
+        self.stats.stream = out
+        out.write(f"{self.samples} sampled updates (rate {self.rate})\n")
+        self.stats.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+
+PROFILER = Profiler(float(os.getenv("PROFILE_SAMPLE_RATE", "0")))
+
+
+def instrument(handler):
+    # Wrap a PTB handler callback: latency, storage reads and optional profiling per update
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        update_reads = [0, 0]
+        token = _update_reads.set(update_reads)
+        profile = PROFILER.start()
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            HANDLER_SECONDS.observe(name, time.perf_counter() - started)
+            PROFILER.stop(profile)
+            UPDATE_READS.observe(name, update_reads[0])
+            UPDATE_READ_BYTES.observe(name, update_reads[1])
+            _update_reads.reset(token)
+    return wrapper
+
+
+def metered_request(**kwargs):
+    # An HTTPXRequest that times every Bot API request by method name. Built on demand so
+    # importing metrics doesn't pull in httpx and aiohttp.
+    from telegram.request import HTTPXRequest
+
+    class MeteredRequest(HTTPXRequest):
+        async def do_request(self, url, method, *args, **kwargs):
+            api_method = url.rsplit("/", 1)[-1] if method == "POST" else "file"
+            with timer(TELEGRAM_SECONDS, api_method):
+                return await super().do_request(url, method, *args, **kwargs)
+
+    return MeteredRequest(**kwargs)
+
+
+async def watch_event_loop(interval=0.5):
+    # A task that should wake up every interval; anything later is time the loop was busy
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(None, max(0.0, time.perf_counter() - started - interval))
+
+
+def create_metrics_app():
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    async def show_profile(request):
+        return web.Response(text=PROFILER.report(int(request.query.get("limit", "40"))))
+
+    async def set_profile_rate(request):
+        try:
+            rate = float(request.query["rate"])
+        except (KeyError, ValueError):
+            return web.Response(status=400, text="rate must be a number between 0 and 1\n")
+        PROFILER.set_rate(min(max(rate, 0.0), 1.0))
+        logger.info("Profile sample rate set to %s", PROFILER.rate)
+        return web.Response(text=f"rate {PROFILER.rate}\n")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/profile", show_profile)
+    app.router.add_post("/profile", set_profile_rate)
+    return app
+
+
+async def start_metrics_server():
+    # Returns the runner to clean up on shutdown, or None if the server is turned off
+    port = int(os.getenv("METRICS_PORT", "0"))
+    if not port:
+        return None
+    host = os.getenv("METRICS_HOST", "127.0.0.1")
+    from aiohttp import web
+    runner = web.AppRunner(create_metrics_app())
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as error:
+        # E.g. the port is taken: the bot runs on without the endpoint
+        logger.error("Metrics server not started on %s:%d: %s", host, port, error)
+        await runner.cleanup()
+        return None
+    logger.info("Metrics on http://%s:%d/metrics", host, port)
+    return runner
@@ -0,0 +1,128 @@
+import bisect
+import asyncio
+import logging
+
+from telegram.error import Forbidden
+
+logger = logging.getLogger(__name__)
+
+# Push notifications: subscribers hear about new listings in their categories, sellers
+# hear about their sales. Handlers only queue them; one background task matches listings
+# against the subscriptions and sends through the rate-limited OutboundDispatcher.
+
+
+class SubscriptionIndex:
+    # category -> list of (max price, user id) sorted by price, with inf for "any price",
+    # so the subscribers of a listing are a suffix of its category's list
+    def __init__(self):
+        self.users = {}  # user id -> {category: max price or None}
+        self.by_category = {}
+
+    def load(self, state):
+        self.users.clear()
+        self.by_category.clear()
+        for user_id, categories in state.items():
+            self.set(user_id, categories)
+
+    def get(self, user_id):
+        return dict(self.users.get(int(user_id), {}))
+
+    def set(self, user_id, categories):
+        # Replace all subscriptions of a user; an empty dict removes them
+        user_id = int(user_id)
+        for category, max_price in self.users.pop(user_id, {}).items():
+            entries = self.by_category[category]
+            del entries[bisect.bisect_left(entries, self._entry(user_id, max_price))]
+        if categories:
+            self.users[user_id] = dict(categories)
+            for category, max_price in categories.items():
+                bisect.insort(self.by_category.setdefault(category, []), self._entry(user_id, max_price))
+
+    @staticmethod
+    def _entry(user_id, max_price):
+        return (float('inf') if max_price is None else float(max_price), user_id)
+
+    def match(self, category, price):
+        entries = self.by_category.get(category, [])
+        return [user_id for _, user_id in entries[bisect.bisect_left(entries, (float(price),)):]]
+
+    def __len__(self):
+        return len(self.users)
+
+
+class Notifier:
+    # Jobs are new listings, matched against the subscriptions when their turn comes, and
+    # single messages. A listing's subscribers are sent to batch_size at a time.
+    def __init__(self, outbound, subscriptions, batch_size=20):
+        self.outbound = outbound
+        self.subscriptions = subscriptions
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.bot = None
+        self.render_listing = None
+        self.sent = 0
+        self.failed = 0
+
+    def start(self, bot, render_listing):
+        # render_listing(item) -> (text, send_message kwargs), or None to skip the listing
+        self.bot = bot
+        self.render_listing = render_listing
+        self.task = asyncio.create_task(self._work())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def listing_added(self, item):
+        self.queue.put_nowait(('listing', item))
+
+    def notify(self, chat_id, text, **kwargs):
+        self.queue.put_nowait(('message', [chat_id], text, kwargs))
+
+    async def _work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                if job[0] == 'listing':
+                    await self._send_listing(job[1])
+                else:
+                    await self._send(*job[1:])
+            except Exception:
+                logger.exception("Notification %s failed", job[0])
+            finally:
+                self.queue.task_done()
+
+    async def _send_listing(self, item):
+        chat_ids = [user_id for user_id in self.subscriptions.match(item['category'], item['price'])
+                    if str(user_id) != str(item['seller_id'])]
+        if not chat_ids:
+            return
+        rendered = self.render_listing(item)
+        if rendered is None:
+            return
+        text, kwargs = rendered
+        await self._send(chat_ids, text, kwargs)
+        logger.info("Listing %s sent to %d subscribers", item['id'], len(chat_ids))
+
+    async def _send(self, chat_ids, text, kwargs):
+        for i in range(0, len(chat_ids), self.batch_size):
+            batch = chat_ids[i:i + self.batch_size]
+            results = await asyncio.gather(*(
+                self.outbound.send(chat_id, self.bot.send_message, chat_id, text, **kwargs) for chat_id in batch
+            ), return_exceptions=True)
+            for chat_id, result in zip(batch, results):
+                if not isinstance(result, Exception):
+                    self.sent += 1
+                    continue
+                self.failed += 1
+                if isinstance(result, Forbidden):
+                    logger.info("Chat %s blocked the bot, notification dropped", chat_id)
+                else:
+                    logger.warning("Notification to chat %s failed: %s", chat_id, result)
+
+    def stats(self):
+        return {'queue_depth': self.queue.qsize(), 'sent': self.sent, 'failed': self.failed,
+                'subscribers': len(self.subscriptions)}
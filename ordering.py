@@ -0,0 +1,43 @@
+import weakref
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Update processing for Application.concurrent_updates: updates of different users run
+# concurrently, up to max_concurrent_updates, but the updates of one user run one after
+# another in the order they arrived. Otherwise a burst of messages from one user (e.g.
+# updates queued while a worker process was starting) could reach the sell flow's steps
+# out of order.
+#
+# A user's update takes its user lock before a slot, so updates waiting behind their own
+# user don't hold slots that other users' updates could run in. PTB's own semaphore, taken
+# before do_process_update(), is therefore made large enough never to be the limit.
+
+UNLIMITED = 2 ** 31
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(UNLIMITED)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.locks = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self.slots:
+                await coroutine
+            return
+        lock = self.locks.get(user.id)
+        if lock is None:
+            lock = self.locks[user.id] = asyncio.Lock()
+        async with lock:
+            async with self.slots:
+                await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
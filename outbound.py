@@ -0,0 +1,105 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Central queue for outgoing Telegram calls. Every send waits for a token from the
+# global bucket (~30 msg/s) and from its chat's bucket (~1 msg/s), and is retried
+# after the delay Telegram asks for when it answers with RetryAfter.
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Take a token and return how long to wait before using it
+    def reserve(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class OutboundDispatcher:
+    # Idle chat buckets are dropped once there are more than this many
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.max_retries = max_retries
+
+        self.queue_depth = 0
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=1000)
+
+    def _reserve(self, chat_id):
+        now = time.monotonic()
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self.chat_buckets = {
+                    key: value for key, value in self.chat_buckets.items() if not value.is_idle(now)
+                }
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return max(self.global_bucket.reserve(now), bucket.reserve(now))
+
+    async def send(self, chat_id, method, *args, **kwargs):
+        # Call a Bot/Message method (e.g. message.reply_text) within the rate limits
+        self.queue_depth += 1
+        started = time.monotonic()
+        try:
+            for attempt in range(self.max_retries + 1):
+                delay = self._reserve(chat_id)
+                if delay:
+                    await asyncio.sleep(delay)
+                try:
+                    result = await method(*args, **kwargs)
+                except RetryAfter as error:
+                    if attempt == self.max_retries:
+                        raise
+                    retry_after = error.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    self.retries += 1
+                    logger.warning("Flood control for chat %s, retrying in %s s", chat_id, retry_after)
+                    await asyncio.sleep(retry_after)
+                    continue
+                self.sent += 1
+                self.latencies.append(time.monotonic() - started)
+                return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.queue_depth -= 1
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+
+        return {
+            'queue_depth': self.queue_depth,
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed,
+            'latency_p50': percentile(0.5),
+            'latency_p99': percentile(0.99),
+        }
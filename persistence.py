@@ -0,0 +1,97 @@
+import asyncio
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class StoragePersistence(BasePersistence):
+    # Keeps context.user_data and context.chat_data (e.g. a half-finished sell flow) in the
+    # listings storage so they survive restarts. The Application hands over changed entries
+    # every update_interval seconds; they are buffered and written in one batch per kind.
+    def __init__(self, storage, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.storage = storage
+        self.data = {'user_data': None, 'chat_data': None}
+        self.pending = {'user_data': {}, 'chat_data': {}}
+        self.flush_task = None
+
+    async def _get(self, kind):
+        if self.data[kind] is None:
+            state = await self.storage.load_state(kind)
+            self.data[kind] = {int(key): value for key, value in state.items()}
+        return self.data[kind]
+
+    def _set(self, kind, key, value):
+        # Empty dicts are dropped, so finished flows don't leave rows behind
+        self.pending[kind][str(key)] = value or None
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_pending())
+
+    async def _flush_pending(self):
+        # Let the Application hand over the rest of this round's changes first
+        await asyncio.sleep(0)
+        try:
+            for kind in self.pending:
+                changes, self.pending[kind] = self.pending[kind], {}
+                if changes:
+                    await self.storage.save_state(kind, changes)
+                    logger.debug("Persisted %d %s entries", len(changes), kind)
+        finally:
+            self.flush_task = None
+
+    async def get_user_data(self):
+        return await self._get('user_data')
+
+    async def get_chat_data(self):
+        return await self._get('chat_data')
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_user_data(self, user_id, data):
+        self._set('user_data', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._set('chat_data', chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._set('user_data', user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._set('chat_data', chat_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self.flush_task is not None:
+            await self.flush_task
+        if any(self.pending.values()):
+            self.flush_task = asyncio.create_task(self._flush_pending())
+            await self.flush_task
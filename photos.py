@@ -0,0 +1,168 @@
+import io
+import os
+import hashlib
+import logging
+import threading
+import functools
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed photo storage: photos/ab/cd/<sha256>.jpg, plus <sha256>.thumb.jpg for
+# list views. Identical uploads share one file. Files no listing or purchase refers to any more are
+# "orphans": without a quota they are deleted right away, with one they are kept (a
+# re-upload reuses them) and evicted least recently released first when over the quota.
+
+
+class PhotoQuotaExceeded(Exception):
+    pass
+
+
+@functools.cache
+def pil_image():
+    # Pillow is optional: without it no thumbnails are made. Imported with the first
+    # photo rather than at startup, where it is one of the slower imports.
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+class PhotoStore:
+    THUMB_SIZE = (320, 320)
+
+    def __init__(self, root="photos", quota_bytes=0):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.refs = {}  # hash -> number of listings and purchases using it
+        self.sizes = {}  # hash -> bytes on disk (original + thumbnail)
+        self.orphans = OrderedDict()  # unreferenced hashes, least recently released first
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def path(self, photo_hash, thumb=False):
+        name = f"{photo_hash}.thumb.jpg" if thumb else f"{photo_hash}.jpg"
+        return os.path.join(self.root, photo_hash[:2], photo_hash[2:4], name)
+
+    def load(self, referenced_hashes):
+        # Called once at startup with the photo_hash of every listing and purchase
+        with self.lock:
+            self.refs.clear()
+            self.sizes.clear()
+            self.orphans.clear()
+            self.total_bytes = 0
+            for photo_hash in referenced_hashes:
+                self.refs[photo_hash] = self.refs.get(photo_hash, 0) + 1
+            found = []
+            for directory, _, files in os.walk(self.root):
+                for name in files:
+                    if name.endswith(".tmp"):
+                        continue
+                    photo_hash = name.split(".")[0]
+                    stat = os.stat(os.path.join(directory, name))
+                    self.sizes[photo_hash] = self.sizes.get(photo_hash, 0) + stat.st_size
+                    self.total_bytes += stat.st_size
+                    if not name.endswith(".thumb.jpg"):
+                        found.append((stat.st_mtime, photo_hash))
+            for _, photo_hash in sorted(found):
+                if photo_hash not in self.refs:
+                    self.orphans[photo_hash] = True
+        logger.info("Photo store: %d files, %d bytes, %d orphaned",
+                    len(self.sizes), self.total_bytes, len(self.orphans))
+
+    def put(self, data):
+        # Store photo bytes (or reuse an identical stored photo) and take a reference.
+        # Returns the fields to put on the item.
+        photo_hash = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if photo_hash in self.sizes and not os.path.exists(self.path(photo_hash)):
+                # Deleted by another process sharing the directory
+                self.total_bytes -= self.sizes.pop(photo_hash)
+            if photo_hash not in self.sizes:
+                self._evict(len(data))
+                if self.quota_bytes and self.total_bytes + len(data) > self.quota_bytes:
+                    raise PhotoQuotaExceeded(f"{self.total_bytes} of {self.quota_bytes} bytes in use")
+                self.sizes[photo_hash] = self._write(photo_hash, data)
+                self.total_bytes += self.sizes[photo_hash]
+            self.orphans.pop(photo_hash, None)
+            self.refs[photo_hash] = self.refs.get(photo_hash, 0) + 1
+        thumb_path = self.path(photo_hash, thumb=True)
+        return {
+            'photo_hash': photo_hash,
+            'photo': self.path(photo_hash),
+            'thumb': thumb_path if os.path.exists(thumb_path) else None,
+        }
+
+    def _write(self, photo_hash, data):
+        path = self.path(photo_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        size = len(data)
+        Image = pil_image()
+        if Image is not None:
+            try:
+                with Image.open(io.BytesIO(data)) as image:
+                    image.thumbnail(self.THUMB_SIZE)
+                    image.convert("RGB").save(self.path(photo_hash, thumb=True), "JPEG", quality=80)
+                size += os.path.getsize(self.path(photo_hash, thumb=True))
+            except OSError:
+                logger.warning("Could not make a thumbnail for %s", photo_hash)
+        return size
+
+    def adopt(self, photo_hash):
+        # Take a reference to a photo another process sharing the directory has stored
+        with self.lock:
+            if photo_hash not in self.sizes:
+                size = 0
+                for thumb in (False, True):
+                    try:
+                        size += os.path.getsize(self.path(photo_hash, thumb))
+                    except FileNotFoundError:
+                        pass
+                self.sizes[photo_hash] = size
+                self.total_bytes += size
+            self.orphans.pop(photo_hash, None)
+            self.refs[photo_hash] = self.refs.get(photo_hash, 0) + 1
+
+    def release(self, photo_hash, delete=True):
+        # Drop one reference; returns the bytes freed on disk. delete=False mirrors a release
+        # by another process sharing the directory, which decides about the files itself.
+        with self.lock:
+            count = self.refs.get(photo_hash, 0) - 1
+            if count > 0:
+                self.refs[photo_hash] = count
+                return 0
+            self.refs.pop(photo_hash, None)
+            if photo_hash not in self.sizes:
+                return 0
+            if not delete:
+                if os.path.exists(self.path(photo_hash)):
+                    self.orphans[photo_hash] = True
+                else:
+                    self.total_bytes -= self.sizes.pop(photo_hash)
+                return 0
+            if not self.quota_bytes:
+                return self._delete(photo_hash)
+            self.orphans[photo_hash] = True
+            return self._evict(0)
+
+    def _evict(self, incoming_bytes):
+        freed = 0
+        while self.quota_bytes and self.orphans and self.total_bytes + incoming_bytes > self.quota_bytes:
+            photo_hash, _ = self.orphans.popitem(last=False)
+            freed += self._delete(photo_hash)
+        return freed
+
+    def _delete(self, photo_hash):
+        for thumb in (False, True):
+            try:
+                os.remove(self.path(photo_hash, thumb))
+            except FileNotFoundError:
+                pass
+        size = self.sizes.pop(photo_hash, 0)
+        self.orphans.pop(photo_hash, None)
+        self.total_bytes -= size
+        return size
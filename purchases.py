@@ -0,0 +1,62 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A purchase goes through two steps. reserve() marks the item as taken: a compare-and-set
+# on its id that only one buyer can win, after which the caller takes the item out of the
+# browse indexes. commit() queues the purchase and waits for it to be written: purchases
+# queued within flush_interval of each other go to Storage.commit_purchases() as one batch
+# (one transaction with SQLite), so a burst of buys doesn't mean one disk sync per buy.
+# The storage checks again that each item is still listed, which catches an item sold by
+# another worker process at the same time.
+
+
+class PurchaseEngine:
+    def __init__(self, flush_interval=0.01):
+        self.storage = None
+        self.flush_interval = flush_interval
+        self.reserved = set()  # ids of items being bought
+        self.pending = []  # (buyer_id, seller_id, item, future)
+        self.flush_task = None
+
+    def reserve(self, item_id):
+        if item_id in self.reserved:
+            return False
+        self.reserved.add(item_id)
+        return True
+
+    async def commit(self, buyer_id, item):
+        # True once the purchase is stored, False if the item turned out to be sold already.
+        # Raises the storage's error if the batch could not be written.
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((buyer_id, item['seller_id'], item, future))
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_pending())
+        try:
+            return await future
+        finally:
+            self.reserved.discard(item['id'])
+
+    async def _flush_pending(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            while self.pending:
+                batch, self.pending = self.pending, []
+                try:
+                    sold = await self.storage.commit_purchases([purchase[:3] for purchase in batch])
+                except Exception as error:
+                    logger.exception("Could not store %d purchases", len(batch))
+                    for *_, future in batch:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+                for _, _, item, future in batch:
+                    if not future.done():
+                        future.set_result(item['id'] in sold)
+        finally:
+            self.flush_task = None
+
+    async def flush(self):
+        if self.flush_task is not None:
+            await self.flush_task
@@ -0,0 +1,56 @@
+# Compact callback_data for inline buttons: "<version><code>[:arg[:arg...]]", e.g. "1b:<item id>".
+# Codes are looked up in a trie, so dispatch costs one step per character of the code
+# whatever the number of routes. Arguments are separated by ':' and converted with the
+# types given when the route was added, so category names or ids can't be misparsed.
+# Buttons from another version of the encoding don't resolve and can be answered as stale.
+
+
+class CallbackRouter:
+    # Telegram's limit for callback_data, in bytes
+    MAX_LENGTH = 64
+
+    def __init__(self, version):
+        self.version = str(version)
+        self.trie = {}  # char -> subtrie; the None key holds (handler, arg_types) of a route
+        self.codes = {}  # handler -> code
+
+    def add(self, code, handler, *arg_types):
+        if not code or ":" in code:
+            raise ValueError(f"Bad callback code {code!r}")
+        node = self.trie
+        for char in code:
+            node = node.setdefault(char, {})
+        if None in node:
+            raise ValueError(f"Callback code {code!r} is already used")
+        node[None] = (handler, arg_types)
+        self.codes[handler] = code
+
+    def pack(self, handler, *args):
+        data = self.version + self.codes[handler] + "".join(f":{arg}" for arg in args)
+        if len(data.encode()) > self.MAX_LENGTH:
+            raise ValueError(f"callback_data longer than {self.MAX_LENGTH} bytes: {data!r}")
+        return data
+
+    def resolve(self, data):
+        # (handler, args) for the route, or None if the data is stale or malformed
+        if not data or not data.startswith(self.version):
+            return None
+        node = self.trie
+        end = len(self.version)
+        while end < len(data) and data[end] != ":":
+            node = node.get(data[end])
+            if node is None:
+                return None
+            end += 1
+        route = node.get(None)
+        if route is None:
+            return None
+
+        handler, arg_types = route
+        values = data[end + 1:].split(":") if end < len(data) else []
+        if len(values) != len(arg_types):
+            return None
+        try:
+            return handler, [arg_type(value) for arg_type, value in zip(arg_types, values)]
+        except (ValueError, IndexError):
+            return None
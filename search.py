@@ -0,0 +1,105 @@
+import re
+import bisect
+
+# In-memory search over listings: an inverted index from word stems to item ids and a
+# sorted (price, id) array per category. Both are updated as items are added or removed.
+
+# Common Russian inflection endings, longest first, so "столы"/"стола"/"столом" share
+# the stem "стол". Queries also match by prefix ("холод" finds "холодильник").
+ENDINGS = sorted("""
+    иями ями ами ого его ому ему ыми ими ой ей ий ый ая яя ое ее ые ие ую юю ов ев ам ям ах ях ом ем
+    ию ья ье ьи ия ие ии а я о е ы и у ю ь й
+""".split(), key=len, reverse=True)
+
+MIN_STEM = 3
+
+WORD_RE = re.compile(r"\w+")
+
+
+def stem(word):
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    return {stem(word) for word in WORD_RE.findall(text.casefold().replace('ё', 'е'))}
+
+
+class SearchIndex:
+    def __init__(self):
+        self.postings = {}  # stem -> set of item ids
+        self.stems = []  # sorted keys of postings, for prefix lookups
+        self.prices = {}  # category -> sorted list of (price, item id)
+        self.items = {}  # item id -> item
+
+    def clear(self):
+        self.postings.clear()
+        self.stems.clear()
+        self.prices.clear()
+        self.items.clear()
+
+    def add(self, item):
+        self.items[item['id']] = item
+        for token in tokenize(item['name']):
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = set()
+                bisect.insort(self.stems, token)
+            ids.add(item['id'])
+        bisect.insort(self.prices.setdefault(item['category'], []), (float(item['price']), item['id']))
+
+    def remove(self, item):
+        if self.items.pop(item['id'], None) is None:
+            return
+        for token in tokenize(item['name']):
+            ids = self.postings.get(token)
+            if ids is None:
+                continue
+            ids.discard(item['id'])
+            if not ids:
+                del self.postings[token]
+                del self.stems[bisect.bisect_left(self.stems, token)]
+        prices = self.prices.get(item['category'], [])
+        entry = (float(item['price']), item['id'])
+        i = bisect.bisect_left(prices, entry)
+        if i < len(prices) and prices[i] == entry:
+            del prices[i]
+
+    def _match_prefix(self, prefix):
+        ids = set()
+        for i in range(bisect.bisect_left(self.stems, prefix), len(self.stems)):
+            if not self.stems[i].startswith(prefix):
+                break
+            ids |= self.postings[self.stems[i]]
+        return ids
+
+    def _in_price_range(self, min_price, max_price):
+        low = (min_price if min_price is not None else float('-inf'),)
+        high = (max_price if max_price is not None else float('inf'), chr(0x10FFFF))
+        ids = set()
+        for prices in self.prices.values():
+            ids.update(item_id for _, item_id in prices[bisect.bisect_left(prices, low):bisect.bisect_right(prices, high)])
+        return ids
+
+    def search(self, query, min_price=None, max_price=None):
+        # Items whose names match every query word, within the price range, newest first
+        matches = None
+        for token in tokenize(query):
+            ids = self._match_prefix(token)
+            matches = ids if matches is None else matches & ids
+            if not matches:
+                return []
+        if min_price is not None or max_price is not None:
+            if matches is None:
+                matches = self._in_price_range(min_price, max_price)
+            else:
+                matches = {
+                    item_id for item_id in matches
+                    if (min_price is None or float(self.items[item_id]['price']) >= min_price)
+                    and (max_price is None or float(self.items[item_id]['price']) <= max_price)
+                }
+        if matches is None:
+            return []
+        return sorted((self.items[item_id] for item_id in matches), key=lambda item: item['created_at'], reverse=True)
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Running totals per user and per category, updated as listings are added, deleted,
+# bought and expired, so the profile and /stats never have to load item lists.
+# Kept in the storage's bot state ('user_stats' and 'category_stats'). Changed entries are
+# written together every flush_interval seconds, not per event, so what a crash loses is
+# made up at startup: the counts are rebuilt from the storage's listing and purchase
+# summaries (the JSON manifest or a GROUP BY, no item files are read), and only each
+# user's last_activity comes from the saved state. With several processes (see
+# cluster.py) all of them keep the counters up to date but only the primary writes them.
+
+
+def empty_user():
+    return {'listings': 0, 'purchased': 0, 'spent': 0.0, 'last_activity': None}
+
+
+def empty_category():
+    return {'listings': 0, 'sold': 0, 'revenue': 0.0}
+
+
+class StatsTable:
+    def __init__(self, flush_interval=5):
+        self.storage = None
+        self.persist = True
+        self.flush_interval = flush_interval
+        self.flush_now = None  # asyncio.Event, created on the event loop
+        self.users = {}  # user id -> empty_user() fields
+        self.categories = {}  # category -> empty_category() fields
+        self.dirty = {'user_stats': set(), 'category_stats': set()}
+        self.flush_task = None
+
+    async def load(self, storage):
+        self.storage = storage
+        saved_users = await storage.load_state('user_stats')
+        saved_categories = await storage.load_state('category_stats')
+        self.users = {user_id: dict(empty_user(), last_activity=stats.get('last_activity'))
+                      for user_id, stats in saved_users.items()}
+        self.categories = {category: empty_category() for category in saved_categories}
+        for seller_id, summary in (await storage.summary()).items():
+            self.users.setdefault(str(seller_id), empty_user())['listings'] += summary['items']
+            for category, count in summary['categories'].items():
+                self.categories.setdefault(category, empty_category())['listings'] += count
+        for buyer_id, summary in (await storage.purchase_summary()).items():
+            buyer = self.users.setdefault(str(buyer_id), empty_user())
+            for category, counts in summary['categories'].items():
+                buyer['purchased'] += counts['items']
+                buyer['spent'] += counts['spent']
+                category_stats = self.categories.setdefault(category, empty_category())
+                category_stats['sold'] += counts['items']
+                category_stats['revenue'] += counts['spent']
+        # Only entries that differ from the saved state are written back
+        self.dirty['user_stats'] = {key for key, stats in self.users.items() if saved_users.get(key) != stats}
+        self.dirty['category_stats'] = {key for key, stats in self.categories.items()
+                                        if saved_categories.get(key) != stats}
+        logger.info("Stats loaded: %d users, %d categories, %d entries corrected",
+                    len(self.users), len(self.categories), sum(len(keys) for keys in self.dirty.values()))
+        if self.persist:
+            await self.flush()
+        else:
+            for keys in self.dirty.values():
+                keys.clear()
+
+    def user(self, user_id):
+        return self.users.get(str(user_id)) or empty_user()
+
+    def _user(self, user_id, active=False):
+        stats = self.users.setdefault(str(user_id), empty_user())
+        if active:
+            stats['last_activity'] = datetime.now().isoformat(timespec='seconds')
+        self.dirty['user_stats'].add(str(user_id))
+        return stats
+
+    def _category(self, category):
+        self.dirty['category_stats'].add(category)
+        return self.categories.setdefault(category, empty_category())
+
+    def _add_purchase(self, buyer_id, item, active=False):
+        buyer = self._user(buyer_id, active)
+        buyer['purchased'] += 1
+        buyer['spent'] += float(item['price'])
+        category = self._category(item['category'])
+        category['sold'] += 1
+        category['revenue'] += float(item['price'])
+
+    def listing_added(self, seller_id, item):
+        self._user(seller_id, active=True)['listings'] += 1
+        self._category(item['category'])['listings'] += 1
+        self._schedule_flush()
+
+    def listing_removed(self, seller_id, item, expired=False):
+        # An expiry is not something the seller did, so it doesn't count as activity
+        self._user(seller_id, active=not expired)['listings'] -= 1
+        self._category(item['category'])['listings'] -= 1
+        self._schedule_flush()
+
+    def purchased(self, buyer_id, item):
+        # A sold item leaves its seller's listings
+        self._user(item['seller_id'])['listings'] -= 1
+        self._category(item['category'])['listings'] -= 1
+        self._add_purchase(buyer_id, item, active=True)
+        self._schedule_flush()
+
+    def totals(self):
+        totals = empty_category()
+        for category in self.categories.values():
+            for key in totals:
+                totals[key] += category[key]
+        totals['users'] = len(self.users)
+        return totals
+
+    def _schedule_flush(self):
+        if not self.persist:
+            for keys in self.dirty.values():
+                keys.clear()
+            return
+        # One flush at a time, so writes of the same entry reach the storage in order
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_dirty())
+
+    def _flush_event(self):
+        if self.flush_now is None:
+            self.flush_now = asyncio.Event()
+        return self.flush_now
+
+    async def _flush_dirty(self):
+        try:
+            try:
+                await asyncio.wait_for(self._flush_event().wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event().clear()
+            while any(self.dirty.values()):
+                for kind, table in (('user_stats', self.users), ('category_stats', self.categories)):
+                    keys, self.dirty[kind] = self.dirty[kind], set()
+                    if keys:
+                        await self.storage.save_state(kind, {key: dict(table[key]) for key in keys})
+        finally:
+            self.flush_task = None
+
+    async def flush(self):
+        # Write what is pending now instead of at the end of the interval
+        if not self.persist:
+            return
+        if self.flush_task is not None:
+            self._flush_event().set()
+            await self.flush_task
+        if any(self.dirty.values()):
+            self._flush_event().set()
+            self.flush_task = asyncio.create_task(self._flush_dirty())
+            await self.flush_task
@@ -0,0 +1,1022 @@
+import os
+import json
+import hashlib
+import sqlite3
+import asyncio
+import logging
+import argparse
+import functools
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import record_read
+
+logger = logging.getLogger(__name__)
+
+# Storage backends for listings and purchased items.
+# Select with STORAGE_BACKEND=json|sqlite (default: json).
+
+
+class Storage:
+    # Listings of one seller, in the order they were added
+    def load_items(self, seller_id):
+        raise NotImplementedError
+
+    def save_items(self, seller_id, items):
+        raise NotImplementedError
+
+    def add_item(self, seller_id, item):
+        items = self.load_items(seller_id)
+        items.append(item)
+        self.save_items(seller_id, items)
+
+    def update_item(self, seller_id, item):
+        items = self.load_items(seller_id)
+        self.save_items(seller_id, [item if old.get('id') == item['id'] else old for old in items])
+
+    # True if the item was still listed
+    def remove_item(self, seller_id, item_id):
+        return bool(self.remove_items(seller_id, [item_id]))
+
+    # Returns the ids that were still listed: another process may have sold or removed
+    # the others already
+    def remove_items(self, seller_id, item_ids):
+        item_ids = set(item_ids)
+        items = self.load_items(seller_id)
+        removed = [item['id'] for item in items if item.get('id') in item_ids]
+        if removed:
+            self.save_items(seller_id, [item for item in items if item.get('id') not in item_ids])
+        return removed
+
+    # Items bought by one user
+    def load_purchased(self, user_id):
+        raise NotImplementedError
+
+    def save_purchased(self, user_id, items):
+        raise NotImplementedError
+
+    def add_purchase(self, user_id, item):
+        items = self.load_purchased(user_id)
+        items.append(item)
+        self.save_purchased(user_id, items)
+
+    def update_purchase(self, user_id, item):
+        items = self.load_purchased(user_id)
+        self.save_purchased(user_id, [item if old.get('id') == item['id'] else old for old in items])
+
+    # Store a batch of (buyer_id, seller_id, item) purchases: sold items leave the seller's
+    # listings and join the buyer's purchases. Items no longer listed are skipped; returns
+    # the ids of the items that were sold.
+    def commit_purchases(self, purchases):
+        by_seller = {}
+        for buyer_id, seller_id, item in purchases:
+            by_seller.setdefault(str(seller_id), []).append((buyer_id, item))
+        sold = set()
+        bought = {}
+        for seller_id, seller_purchases in by_seller.items():
+            listed = {item.get('id') for item in self.load_items(seller_id)}
+            for buyer_id, item in seller_purchases:
+                if item['id'] in listed and item['id'] not in sold:
+                    sold.add(item['id'])
+                    bought.setdefault(str(buyer_id), []).append(item)
+            sold_ids = [item['id'] for _, item in seller_purchases if item['id'] in sold]
+            if sold_ids:
+                self.remove_items(seller_id, sold_ids)
+        for buyer_id, items in bought.items():
+            if len(items) == 1:
+                self.add_purchase(buyer_id, items[0])
+            else:
+                self.save_purchased(buyer_id, self.load_purchased(buyer_id) + items)
+        return sold
+
+    # (seller_id, item) for every listing, used to build the in-memory index
+    def all_items(self):
+        raise NotImplementedError
+
+    # user_id -> purchased items for every buyer, used by the migrator
+    def all_purchased(self):
+        raise NotImplementedError
+
+    # seller_id -> listing_summary() of the seller's items, for passes that only need counts
+    def summary(self):
+        listings = {}
+        for seller_id, item in self.all_items():
+            listings.setdefault(str(seller_id), []).append(item)
+        return {seller_id: listing_summary(items) for seller_id, items in listings.items()}
+
+    # buyer_id -> purchase_summary() of the buyer's purchases, for the same passes
+    def purchase_summary(self):
+        return {str(buyer_id): purchase_summary(items) for buyer_id, items in self.all_purchased() if items}
+
+    # photo_hash -> number of purchases showing that photo, for the photo store's references
+    def purchased_photos(self):
+        photos = {}
+        for _, items in self.all_purchased():
+            add_photos(photos, items)
+        return photos
+
+    # Bot state such as context.user_data, as {key: data} per kind
+    def load_state(self, kind):
+        raise NotImplementedError
+
+    # Apply {key: data} changes in one write; None deletes the key
+    def save_state(self, kind, changes):
+        raise NotImplementedError
+
+    # Every kind of bot state stored, used by the migrator
+    def state_kinds(self):
+        raise NotImplementedError
+
+    # Something that changes whenever a user's listings ('items') or purchases ('purchased')
+    # are written, by this process or another one; None if the backend can't tell
+    def version(self, kind, user_id):
+        return None
+
+    def close(self):
+        pass
+
+
+def listing_summary(items):
+    categories = {}
+    for item in items:
+        categories[item['category']] = categories.get(item['category'], 0) + 1
+    return {'items': len(items), 'min_created_at': min(item['created_at'] for item in items),
+            'categories': categories}
+
+
+def purchase_summary(items):
+    # Count and total price of the purchases per category
+    categories = {}
+    for item in items:
+        add_purchase_summary(categories, item)
+    return {'items': len(items), 'categories': categories}
+
+
+def add_purchase_summary(categories, item):
+    entry = categories.setdefault(item['category'], {'items': 0, 'spent': 0.0})
+    entry['items'] += 1
+    entry['spent'] += float(item['price'])
+
+
+def add_photos(photos, items):
+    for item in items:
+        if item.get('photo_hash'):
+            photos[item['photo_hash']] = photos.get(item['photo_hash'], 0) + 1
+
+
+def apply_change(items, change):
+    # Changes are the records written to a journal: add, update or remove items by id
+    if change['op'] == 'add':
+        return items + [change['item']]
+    if change['op'] == 'update':
+        return [change['item'] if item.get('id') == change['item']['id'] else item for item in items]
+    if change['op'] == 'remove':
+        item_ids = set(change['ids'])
+        return [item for item in items if item.get('id') not in item_ids]
+    raise ValueError(f"Unknown change: {change['op']}")
+
+
+class JSONStorage(Storage):
+    # One user_data_{id}.json (listings) and user_data_purchased_{id}.json per user, in
+    # users/<shard>/ where the shard is the first two hex digits of the md5 of the user id,
+    # so no directory grows past a few hundred files per 100k users.
+    # Files are replaced atomically (temp file + fsync + os.replace) under a per-file lock.
+    # In journal mode single-item changes are appended to user_data_{id}.journal and folded
+    # into the .json file once the journal holds compact_after changes. Bot state is always
+    # journaled the same way (bot_state_{kind}.journal), since it changes in small batches
+    # and the whole state can be large, e.g. the counters of every user.
+    #
+    # manifest.json lists every seller with listing_summary() of their items and every buyer
+    # with purchase_summary() of theirs plus the photos they use, so startup, stats and the
+    # photo store's reference counts open only files that have data and
+    # never list directories. It is written on close() and marked unclean before the first
+    # change after that; an unclean or missing manifest (a crash, or files of the old flat
+    # layout) is rebuilt by scanning the shards once.
+    #
+    # commit_purchases() writes each batch to purchases.journal with one fsync before it
+    # touches any user file: that write is the commit. The batch is then applied to the
+    # seller and buyer files and the journal removed; a batch left in the journal by a
+    # crash or a failed apply is applied again on the next start (or before the next
+    # batch), which is idempotent. Once journaled, a purchase is reported as sold.
+    SHARDS_DIR = "users"
+    MANIFEST = "manifest.json"
+    PURCHASES_JOURNAL = "purchases.journal"
+
+    def __init__(self, data_dir=".", journal=False, compact_after=100):
+        self.data_dir = data_dir
+        self.journal = journal
+        self.compact_after = compact_after
+        self._journal_sizes = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self.sellers = {}  # seller_id -> listing_summary()
+        self.buyers = {}  # user_id -> purchase_summary() and 'photos': {photo_hash: count}
+        self._manifest_clean = False
+        self._manifest_lock = threading.Lock()
+        self._purchases_lock = threading.Lock()
+        self._open_manifest()
+        with self._purchases_lock:
+            self._replay_purchases()
+
+    def _shard_dir(self, key):
+        user_id = str(key)
+        if user_id.startswith("purchased_"):
+            user_id = user_id[len("purchased_"):]
+        return os.path.join(self.data_dir, self.SHARDS_DIR, hashlib.md5(user_id.encode()).hexdigest()[:2])
+
+    def _path(self, key):
+        return os.path.join(self._shard_dir(key), f"user_data_{key}.json")
+
+    def _journal_path(self, key):
+        return os.path.join(self._shard_dir(key), f"user_data_{key}.journal")
+
+    def _dump_json(self, path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _open_manifest(self):
+        try:
+            manifest = self._load_json(os.path.join(self.data_dir, self.MANIFEST))
+        except (FileNotFoundError, ValueError):
+            manifest = None
+        # Manifests that only kept a purchase count per buyer are rebuilt as well
+        if manifest and manifest['clean'] and all(isinstance(entry, dict) and 'photos' in entry
+                                                  for entry in manifest['buyers'].values()):
+            self.sellers = manifest['sellers']
+            self.buyers = manifest['buyers']
+            self._manifest_clean = True
+        else:
+            self._rebuild_manifest()
+
+    def _rebuild_manifest(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        keys = set()
+        for name in os.listdir(self.data_dir):
+            key = self._file_key(name)
+            if key is not None:
+                # Files of the flat layout move into their shard
+                os.makedirs(self._shard_dir(key), exist_ok=True)
+                os.replace(os.path.join(self.data_dir, name), os.path.join(self._shard_dir(key), name))
+                keys.add(key)
+        shards_dir = os.path.join(self.data_dir, self.SHARDS_DIR)
+        for shard in os.listdir(shards_dir) if os.path.isdir(shards_dir) else []:
+            for name in os.listdir(os.path.join(shards_dir, shard)):
+                key = self._file_key(name)
+                if key is not None:
+                    keys.add(key)
+        self.sellers.clear()
+        self.buyers.clear()
+        for key in keys:
+            self._count(key, self._read(key))
+        self._write_manifest(clean=True)
+        logger.info("Manifest rebuilt: %d sellers, %d buyers", len(self.sellers), len(self.buyers))
+
+    @staticmethod
+    def _file_key(name):
+        for suffix in (".json", ".journal"):
+            if name.startswith("user_data_") and name.endswith(suffix):
+                return name[len("user_data_"):-len(suffix)]
+        return None
+
+    def _write_manifest(self, clean):
+        self._dump_json(os.path.join(self.data_dir, self.MANIFEST),
+                        {'clean': clean, 'sellers': self.sellers, 'buyers': self.buyers})
+        self._manifest_clean = clean
+
+    def _changing(self):
+        # Called before every write: a crash from now on leaves an unclean manifest
+        with self._manifest_lock:
+            if self._manifest_clean:
+                self._write_manifest(clean=False)
+
+    def _count(self, key, items):
+        # Update the manifest entry of a key from its new contents
+        key = str(key)
+        with self._manifest_lock:
+            if key.startswith("purchased_"):
+                table, user_id, entry = self.buyers, key[len("purchased_"):], None
+                if items:
+                    entry = dict(purchase_summary(items), photos={})
+                    add_photos(entry['photos'], items)
+            else:
+                table, user_id, entry = self.sellers, key, listing_summary(items) if items else None
+            if entry:
+                table[user_id] = entry
+            else:
+                table.pop(user_id, None)
+
+    def _count_added(self, key, item):
+        key = str(key)
+        with self._manifest_lock:
+            if key.startswith("purchased_"):
+                entry = self.buyers.setdefault(key[len("purchased_"):], {'items': 0, 'categories': {}, 'photos': {}})
+                entry['items'] += 1
+                add_purchase_summary(entry['categories'], item)
+                add_photos(entry['photos'], [item])
+                return
+            entry = self.sellers.get(key)
+            if entry is None:
+                self.sellers[key] = listing_summary([item])
+                return
+            entry['items'] += 1
+            entry['min_created_at'] = min(entry['min_created_at'], item['created_at'])
+            entry['categories'][item['category']] = entry['categories'].get(item['category'], 0) + 1
+
+    def _lock(self, key):
+        # Callers pass ids as int or str; both must get the same lock
+        key = str(key)
+        with self._locks_lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def _load_json(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        record_read(len(data))
+        return json.loads(data)
+
+    def _read_journal(self, path):
+        try:
+            with open(path, "rb") as f:
+                journal = f.read()
+        except FileNotFoundError:
+            return []
+        record_read(len(journal))
+        changes = []
+        for line in journal.splitlines():
+            try:
+                changes.append(json.loads(line))
+            except ValueError:
+                # A crash in the middle of an append leaves a partial last line
+                continue
+        return changes
+
+    def _append_journal(self, path, change):
+        with open(path, "ab+") as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # The last append was cut short by a crash: don't extend its partial line
+                    f.write(b"\n")
+            f.write(json.dumps(change).encode() + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read(self, key):
+        try:
+            items = self._load_json(self._path(key))
+        except FileNotFoundError:
+            items = []
+        changes = self._read_journal(self._journal_path(key))
+        for change in changes:
+            items = apply_change(items, change)
+        self._journal_sizes[key] = len(changes)
+        return items
+
+    def _write(self, key, items):
+        os.makedirs(self._shard_dir(key), exist_ok=True)
+        self._dump_json(self._path(key), items)
+        # The snapshot now includes every journaled change
+        if self._journal_sizes.get(key, 1):
+            try:
+                os.remove(self._journal_path(key))
+            except FileNotFoundError:
+                pass
+        self._journal_sizes[key] = 0
+
+    def _change(self, key, change):
+        # Returns the ids a 'remove' change actually removed
+        self._changing()
+        with self._lock(key):
+            if change['op'] == 'remove' or not self.journal:
+                items = self._read(key)
+            if change['op'] == 'remove':
+                listed = {item.get('id') for item in items}
+                change = dict(change, ids=[item_id for item_id in change['ids'] if item_id in listed])
+                if not change['ids']:
+                    return []
+            if not self.journal:
+                items = apply_change(items, change)
+                self._write(key, items)
+                self._count(key, items)
+                return change.get('ids')
+            if key not in self._journal_sizes:
+                self._read(key)
+            os.makedirs(self._shard_dir(key), exist_ok=True)
+            self._append_journal(self._journal_path(key), change)
+            self._journal_sizes[key] += 1
+            if change['op'] == 'add':
+                self._count_added(key, change['item'])
+            elif change['op'] == 'remove':
+                # Which categories lost an item is only known from the items themselves
+                self._count(key, self._read(key))
+            if self._journal_sizes[key] >= self.compact_after:
+                self._write(key, self._read(key))
+            return change.get('ids')
+
+    def _load(self, key):
+        with self._lock(key):
+            return self._read(key)
+
+    def _save(self, key, items):
+        self._changing()
+        with self._lock(key):
+            self._write(key, items)
+            self._count(key, items)
+
+    def load_items(self, seller_id):
+        return self._load(seller_id)
+
+    def save_items(self, seller_id, items):
+        self._save(seller_id, items)
+
+    def add_item(self, seller_id, item):
+        self._change(seller_id, {'op': 'add', 'item': item})
+
+    def update_item(self, seller_id, item):
+        self._change(seller_id, {'op': 'update', 'item': item})
+
+    def remove_items(self, seller_id, item_ids):
+        return self._change(seller_id, {'op': 'remove', 'ids': list(item_ids)})
+
+    def load_purchased(self, user_id):
+        return self._load(f"purchased_{user_id}")
+
+    def save_purchased(self, user_id, items):
+        self._save(f"purchased_{user_id}", items)
+
+    def add_purchase(self, user_id, item):
+        self._change(f"purchased_{user_id}", {'op': 'add', 'item': item})
+
+    def update_purchase(self, user_id, item):
+        self._change(f"purchased_{user_id}", {'op': 'update', 'item': item})
+
+    def version(self, kind, user_id):
+        key = user_id if kind == 'items' else f"purchased_{user_id}"
+        stamps = []
+        for path in (self._path(key), self._journal_path(key)):
+            try:
+                stat = os.stat(path)
+                stamps.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def _state_path(self, kind):
+        return os.path.join(self.data_dir, f"bot_state_{kind}.json")
+
+    def _state_journal_path(self, kind):
+        return os.path.join(self.data_dir, f"bot_state_{kind}.journal")
+
+    def _read_state(self, kind):
+        try:
+            state = self._load_json(self._state_path(kind))
+        except FileNotFoundError:
+            state = {}
+        changes = self._read_journal(self._state_journal_path(kind))
+        for change in changes:
+            for key, data in change.items():
+                if data is None:
+                    state.pop(key, None)
+                else:
+                    state[key] = data
+        self._journal_sizes[f"state_{kind}"] = len(changes)
+        return state
+
+    def load_state(self, kind):
+        with self._lock(f"state_{kind}"):
+            return self._read_state(kind)
+
+    def save_state(self, kind, changes):
+        # Appends the changes; the state file is only rewritten every compact_after saves
+        key = f"state_{kind}"
+        with self._lock(key):
+            if key not in self._journal_sizes:
+                self._read_state(kind)
+            os.makedirs(self.data_dir, exist_ok=True)
+            self._append_journal(self._state_journal_path(kind), changes)
+            self._journal_sizes[key] += 1
+            if self._journal_sizes[key] >= self.compact_after:
+                self._dump_json(self._state_path(kind), self._read_state(kind))
+                os.remove(self._state_journal_path(kind))
+                self._journal_sizes[key] = 0
+
+    def state_kinds(self):
+        try:
+            names = os.listdir(self.data_dir)
+        except FileNotFoundError:
+            return []
+        kinds = set()
+        for name in names:
+            for suffix in (".json", ".journal"):
+                if name.startswith("bot_state_") and name.endswith(suffix):
+                    kinds.add(name[len("bot_state_"):-len(suffix)])
+        return sorted(kinds)
+
+    def commit_purchases(self, purchases):
+        path = os.path.join(self.data_dir, self.PURCHASES_JOURNAL)
+        with self._purchases_lock:
+            # A batch whose apply failed earlier is finished first
+            self._replay_purchases()
+            sold = set()
+            batch = []
+            listed = {}
+            for buyer_id, seller_id, item in purchases:
+                seller_id = str(seller_id)
+                if seller_id not in listed:
+                    listed[seller_id] = {listed_item.get('id') for listed_item in self.load_items(seller_id)}
+                if item['id'] in listed[seller_id] and item['id'] not in sold:
+                    sold.add(item['id'])
+                    batch.append([str(buyer_id), seller_id, item])
+            if batch:
+                os.makedirs(self.data_dir, exist_ok=True)
+                self._append_journal(path, batch)
+                # The batch is committed now: if applying it fails, the replay finishes it
+                try:
+                    self._apply_purchases(batch)
+                    os.remove(path)
+                except Exception:
+                    logger.exception("Could not apply %d purchases, they will be applied from the journal", len(batch))
+            return sold
+
+    def _apply_purchases(self, batch, replay=False):
+        by_seller = {}
+        by_buyer = {}
+        for buyer_id, seller_id, item in batch:
+            by_seller.setdefault(seller_id, []).append(item['id'])
+            by_buyer.setdefault(buyer_id, []).append(item)
+        for seller_id, item_ids in by_seller.items():
+            # Removing by id is idempotent
+            self.remove_items(seller_id, item_ids)
+        for buyer_id, items in by_buyer.items():
+            if replay:
+                # Purchases stored before the crash are not added twice
+                owned = {item.get('id') for item in self.load_purchased(buyer_id)}
+                items = [item for item in items if item['id'] not in owned]
+            if len(items) == 1:
+                self.add_purchase(buyer_id, items[0])
+            elif items:
+                self.save_purchased(buyer_id, self.load_purchased(buyer_id) + items)
+
+    def _replay_purchases(self):
+        # Called with _purchases_lock held
+        path = os.path.join(self.data_dir, self.PURCHASES_JOURNAL)
+        batches = self._read_journal(path)
+        for batch in batches:
+            self._apply_purchases(batch, replay=True)
+        if batches:
+            logger.info("Applied %d purchase batches left by an interrupted commit", len(batches))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def all_items(self):
+        with self._manifest_lock:
+            seller_ids = sorted(self.sellers)
+        for seller_id in seller_ids:
+            for item in self.load_items(seller_id):
+                yield seller_id, item
+
+    def all_purchased(self):
+        with self._manifest_lock:
+            user_ids = sorted(self.buyers)
+        for user_id in user_ids:
+            yield user_id, self.load_purchased(user_id)
+
+    def summary(self):
+        with self._manifest_lock:
+            return {seller_id: dict(entry, categories=dict(entry['categories']))
+                    for seller_id, entry in self.sellers.items()}
+
+    def purchase_summary(self):
+        with self._manifest_lock:
+            return {buyer_id: {'items': entry['items'],
+                               'categories': {category: dict(counts) for category, counts in entry['categories'].items()}}
+                    for buyer_id, entry in self.buyers.items()}
+
+    def purchased_photos(self):
+        photos = {}
+        with self._manifest_lock:
+            for entry in self.buyers.values():
+                for photo_hash, count in entry['photos'].items():
+                    photos[photo_hash] = photos.get(photo_hash, 0) + count
+        return photos
+
+    def close(self):
+        with self._manifest_lock:
+            self._write_manifest(clean=True)
+
+
+class SQLiteStorage(Storage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY,
+            item_id TEXT UNIQUE,
+            seller_id TEXT NOT NULL,
+            category TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS items_category_created_at ON items (category, created_at);
+        CREATE INDEX IF NOT EXISTS items_seller_id ON items (seller_id);
+        CREATE TABLE IF NOT EXISTS purchases (
+            id INTEGER PRIMARY KEY,
+            buyer_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS purchases_buyer_id ON purchases (buyer_id);
+        CREATE TABLE IF NOT EXISTS state (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (kind, key)
+        );
+    """
+
+    # Statements are kept constant so sqlite3 reuses its prepared statement cache
+    SELECT_ITEMS = "SELECT data FROM items WHERE seller_id = ? ORDER BY id"
+    DELETE_ITEMS = "DELETE FROM items WHERE seller_id = ?"
+    INSERT_ITEM = "INSERT INTO items (item_id, seller_id, category, created_at, data) VALUES (?, ?, ?, ?, ?)"
+    DELETE_ITEM = "DELETE FROM items WHERE item_id = ? AND seller_id = ?"
+    UPDATE_ITEM = "UPDATE items SET data = ? WHERE item_id = ? AND seller_id = ?"
+    SELECT_ALL_ITEMS = "SELECT seller_id, data FROM items ORDER BY id"
+    SELECT_PURCHASED = "SELECT data FROM purchases WHERE buyer_id = ? ORDER BY id"
+    DELETE_PURCHASED = "DELETE FROM purchases WHERE buyer_id = ?"
+    INSERT_PURCHASE = "INSERT INTO purchases (buyer_id, data) VALUES (?, ?)"
+    UPDATE_PURCHASE = "UPDATE purchases SET data = ? WHERE buyer_id = ? AND json_extract(data, '$.id') = ?"
+    SELECT_ALL_PURCHASED = "SELECT buyer_id, data FROM purchases ORDER BY buyer_id, id"
+    SELECT_SUMMARY = ("SELECT seller_id, category, COUNT(*), MIN(created_at) FROM items "
+                      "GROUP BY seller_id, category")
+    SELECT_PURCHASE_SUMMARY = ("SELECT buyer_id, json_extract(data, '$.category'), COUNT(*), "
+                               "SUM(json_extract(data, '$.price')) FROM purchases GROUP BY 1, 2")
+    SELECT_PURCHASED_PHOTOS = ("SELECT json_extract(data, '$.photo_hash'), COUNT(*) FROM purchases "
+                               "WHERE json_extract(data, '$.photo_hash') IS NOT NULL GROUP BY 1")
+    SELECT_STATE = "SELECT key, data FROM state WHERE kind = ?"
+    UPSERT_STATE = "INSERT OR REPLACE INTO state (kind, key, data) VALUES (?, ?, ?)"
+    DELETE_STATE = "DELETE FROM state WHERE kind = ? AND key = ?"
+    SELECT_STATE_KINDS = "SELECT DISTINCT kind FROM state ORDER BY kind"
+
+    def __init__(self, path="stuff_misis.db"):
+        self.path = path
+        # One connection per thread: WAL lets the storage pool read in parallel
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, cached_statements=64, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _item_row(self, seller_id, item):
+        return (item.get('id'), str(seller_id), item['category'], item['created_at'], json.dumps(item))
+
+    def _select(self, sql, params=()):
+        # The JSON data is the last column of every query that reads rows
+        rows = self.conn.execute(sql, params).fetchall()
+        record_read(sum(len(row[-1]) for row in rows), reads=len(rows))
+        return rows
+
+    def load_items(self, seller_id):
+        return [json.loads(data) for (data,) in self._select(self.SELECT_ITEMS, (str(seller_id),))]
+
+    def save_items(self, seller_id, items):
+        with self.conn:
+            self.conn.execute(self.DELETE_ITEMS, (str(seller_id),))
+            self.conn.executemany(self.INSERT_ITEM, [self._item_row(seller_id, item) for item in items])
+
+    def add_item(self, seller_id, item):
+        with self.conn:
+            self.conn.execute(self.INSERT_ITEM, self._item_row(seller_id, item))
+
+    def update_item(self, seller_id, item):
+        with self.conn:
+            self.conn.execute(self.UPDATE_ITEM, (json.dumps(item), item['id'], str(seller_id)))
+
+    def remove_items(self, seller_id, item_ids):
+        # The DELETE's rowcount tells which items were still there
+        with self.conn:
+            return [item_id for item_id in item_ids
+                    if self.conn.execute(self.DELETE_ITEM, (item_id, str(seller_id))).rowcount]
+
+    def load_purchased(self, user_id):
+        return [json.loads(data) for (data,) in self._select(self.SELECT_PURCHASED, (str(user_id),))]
+
+    def save_purchased(self, user_id, items):
+        with self.conn:
+            self.conn.execute(self.DELETE_PURCHASED, (str(user_id),))
+            self.conn.executemany(self.INSERT_PURCHASE, [(str(user_id), json.dumps(item)) for item in items])
+
+    def add_purchase(self, user_id, item):
+        with self.conn:
+            self.conn.execute(self.INSERT_PURCHASE, (str(user_id), json.dumps(item)))
+
+    def update_purchase(self, user_id, item):
+        with self.conn:
+            self.conn.execute(self.UPDATE_PURCHASE, (json.dumps(item), str(user_id), item['id']))
+
+    def commit_purchases(self, purchases):
+        # One transaction; deleting the listing is the check that it wasn't sold already,
+        # also by another process
+        sold = set()
+        with self.conn:
+            for buyer_id, seller_id, item in purchases:
+                if self.conn.execute(self.DELETE_ITEM, (item['id'], str(seller_id))).rowcount:
+                    self.conn.execute(self.INSERT_PURCHASE, (str(buyer_id), json.dumps(item)))
+                    sold.add(item['id'])
+        return sold
+
+    def all_items(self):
+        for seller_id, data in self._select(self.SELECT_ALL_ITEMS):
+            yield seller_id, json.loads(data)
+
+    def all_purchased(self):
+        purchased = {}
+        for buyer_id, data in self._select(self.SELECT_ALL_PURCHASED):
+            purchased.setdefault(buyer_id, []).append(json.loads(data))
+        yield from purchased.items()
+
+    def summary(self):
+        sellers = {}
+        for seller_id, category, count, min_created_at in self._select(self.SELECT_SUMMARY):
+            entry = sellers.setdefault(seller_id, {'items': 0, 'min_created_at': min_created_at, 'categories': {}})
+            entry['items'] += count
+            entry['min_created_at'] = min(entry['min_created_at'], min_created_at)
+            entry['categories'][category] = count
+        return sellers
+
+    def purchase_summary(self):
+        buyers = {}
+        # Aggregates only, so not counted as reads like _select() rows
+        for buyer_id, category, count, spent in self.conn.execute(self.SELECT_PURCHASE_SUMMARY):
+            entry = buyers.setdefault(buyer_id, {'items': 0, 'categories': {}})
+            entry['items'] += count
+            entry['categories'][category] = {'items': count, 'spent': float(spent)}
+        return buyers
+
+    def purchased_photos(self):
+        return dict(self.conn.execute(self.SELECT_PURCHASED_PHOTOS).fetchall())
+
+    def load_state(self, kind):
+        return {key: json.loads(data) for key, data in self._select(self.SELECT_STATE, (kind,))}
+
+    def state_kinds(self):
+        return [kind for (kind,) in self._select(self.SELECT_STATE_KINDS)]
+
+    def save_state(self, kind, changes):
+        with self.conn:
+            self.conn.executemany(self.UPSERT_STATE, [
+                (kind, key, json.dumps(data)) for key, data in changes.items() if data is not None
+            ])
+            self.conn.executemany(self.DELETE_STATE, [
+                (kind, key) for key, data in changes.items() if data is None
+            ])
+
+    def version(self, kind, user_id):
+        # Rows don't have an mtime, so any write to the database counts as a change
+        stamps = []
+        for path in (self.path, self.path + "-wal"):
+            try:
+                stat = os.stat(path)
+                stamps.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class CachedStorage(Storage):
+    # Read-through LRU cache of listings and purchases per user in front of another Storage,
+    # bounded by the JSON size of the cached lists. Writes made through it update or drop
+    # the entry; writes from elsewhere (another process, an edited file) are noticed by
+    # comparing the backend's version() with the one seen when the entry was read.
+    def __init__(self, storage, max_bytes):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (kind, user_id) -> (version, items, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _get(self, kind, user_id, load):
+        key = (kind, str(user_id))
+        # Taken before reading, so a write racing with the read makes the entry stale, not wrong
+        version = self.storage.version(kind, user_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and version is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return [dict(item) for item in entry[1]]
+            self.misses += 1
+        items = load(user_id)
+        self._put(key, version, items)
+        return [dict(item) for item in items]
+
+    def _put(self, key, version, items):
+        items = [dict(item) for item in items]
+        size = len(json.dumps(items))
+        with self.lock:
+            self._drop(key)
+            if version is None or size > self.max_bytes:
+                return
+            self.entries[key] = (version, items, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def _invalidate(self, kind, user_id):
+        with self.lock:
+            self._drop((kind, str(user_id)))
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.bytes}
+
+    def load_items(self, seller_id):
+        return self._get('items', seller_id, self.storage.load_items)
+
+    def save_items(self, seller_id, items):
+        self._invalidate('items', seller_id)
+        self.storage.save_items(seller_id, items)
+        self._put(('items', str(seller_id)), self.storage.version('items', seller_id), items)
+
+    def add_item(self, seller_id, item):
+        self._invalidate('items', seller_id)
+        self.storage.add_item(seller_id, item)
+
+    def update_item(self, seller_id, item):
+        self._invalidate('items', seller_id)
+        self.storage.update_item(seller_id, item)
+
+    def remove_items(self, seller_id, item_ids):
+        self._invalidate('items', seller_id)
+        return self.storage.remove_items(seller_id, item_ids)
+
+    def load_purchased(self, user_id):
+        return self._get('purchased', user_id, self.storage.load_purchased)
+
+    def save_purchased(self, user_id, items):
+        self._invalidate('purchased', user_id)
+        self.storage.save_purchased(user_id, items)
+        self._put(('purchased', str(user_id)), self.storage.version('purchased', user_id), items)
+
+    def add_purchase(self, user_id, item):
+        self._invalidate('purchased', user_id)
+        self.storage.add_purchase(user_id, item)
+
+    def update_purchase(self, user_id, item):
+        self._invalidate('purchased', user_id)
+        self.storage.update_purchase(user_id, item)
+
+    def commit_purchases(self, purchases):
+        for buyer_id, seller_id, item in purchases:
+            self._invalidate('purchased', buyer_id)
+            self._invalidate('items', seller_id)
+        return self.storage.commit_purchases(purchases)
+
+    def all_items(self):
+        return self.storage.all_items()
+
+    def all_purchased(self):
+        return self.storage.all_purchased()
+
+    def summary(self):
+        return self.storage.summary()
+
+    def purchase_summary(self):
+        return self.storage.purchase_summary()
+
+    def purchased_photos(self):
+        return self.storage.purchased_photos()
+
+    def load_state(self, kind):
+        return self.storage.load_state(kind)
+
+    def save_state(self, kind, changes):
+        self.storage.save_state(kind, changes)
+
+    def state_kinds(self):
+        return self.storage.state_kinds()
+
+    def version(self, kind, user_id):
+        return self.storage.version(kind, user_id)
+
+    def close(self):
+        self.storage.close()
+
+
+class AsyncStorage:
+    # Runs a Storage's blocking calls in a bounded thread pool so handlers can await them
+    # without stalling the event loop. max_concurrency caps disk operations in flight.
+    def __init__(self, storage, max_concurrency=4):
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="storage")
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(self, func, *args, **kwargs):
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            # Run in a copy of the caller's context so metrics know which update a read belongs to
+            call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+            return await loop.run_in_executor(self.executor, call)
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def call(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+        return call
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.storage.close()
+
+
+def open_storage(asynchronous=False):
+    storage = _open_backend()
+    # STORAGE_CACHE_MB=0 turns the per-user cache off
+    cache_bytes = int(float(os.getenv("STORAGE_CACHE_MB", "16")) * 1024 * 1024)
+    if cache_bytes:
+        storage = CachedStorage(storage, cache_bytes)
+    if asynchronous:
+        return AsyncStorage(storage, int(os.getenv("STORAGE_MAX_CONCURRENCY", "4")))
+    return storage
+
+
+def _open_backend():
+    backend = os.getenv("STORAGE_BACKEND", "json")
+    if backend == "sqlite":
+        return SQLiteStorage(os.getenv("SQLITE_PATH", "stuff_misis.db"))
+    if backend == "json":
+        return JSONStorage(
+            os.getenv("DATA_DIR", "."),
+            journal=os.getenv("JSON_JOURNAL", "0") == "1",
+            compact_after=int(os.getenv("JSON_JOURNAL_COMPACT_AFTER", "100")),
+        )
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+def migrate(source, target):
+    # Copy every seller's listings and every buyer's purchases; safe to re-run
+    listings = {}
+    for seller_id, item in source.all_items():
+        listings.setdefault(seller_id, []).append(item)
+    for seller_id, items in listings.items():
+        target.save_items(seller_id, items)
+    purchases = 0
+    for user_id, items in source.all_purchased():
+        target.save_purchased(user_id, items)
+        purchases += len(items)
+    # Sell flows, subscriptions, stats counters and any other kind of bot state
+    kinds = source.state_kinds()
+    for kind in kinds:
+        target.save_state(kind, source.load_state(kind))
+    logger.info("Migrated %d sellers (%d items), %d purchases and bot state (%s)",
+                len(listings), sum(len(items) for items in listings.values()), purchases, ", ".join(kinds))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Import user_data_*.json files into the SQLite store")
+    parser.add_argument("--data-dir", default=os.getenv("DATA_DIR", "."))
+    parser.add_argument("--db", default=os.getenv("SQLITE_PATH", "stuff_misis.db"))
+    args = parser.parse_args()
+    source = JSONStorage(args.data_dir)
+    target = SQLiteStorage(args.db)
+    migrate(source, target)
+    source.close()
+    target.close()
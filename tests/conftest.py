@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The bot's modules live at the top of the repository, next to ru.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
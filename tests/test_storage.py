@@ -0,0 +1,110 @@
+import os
+import json
+
+import pytest
+
+from storage import JSONStorage, SQLiteStorage, CachedStorage
+
+
+def make_item(item_id, **fields):
+    return dict({'id': item_id, 'name': item_id, 'price': 10.0, 'category': 'Мебель',
+                 'created_at': '2026-01-01'}, **fields)
+
+
+def test_journal_replay_skips_truncated_last_line(tmp_path):
+    storage = JSONStorage(str(tmp_path), journal=True)
+    storage.add_item(1, make_item('a'))
+    storage.add_item(1, make_item('b'))
+    # A crash in the middle of an append
+    with open(storage._journal_path('1'), 'a') as f:
+        f.write('{"op": "add", "item": {"id": "c"')
+
+    storage = JSONStorage(str(tmp_path), journal=True)
+    assert [item['id'] for item in storage.load_items(1)] == ['a', 'b']
+
+    # The next change doesn't end up on the partial line
+    storage.add_item(1, make_item('d'))
+    storage = JSONStorage(str(tmp_path), journal=True)
+    assert [item['id'] for item in storage.load_items(1)] == ['a', 'b', 'd']
+
+
+def test_journal_compacts_after_compact_after_changes(tmp_path):
+    storage = JSONStorage(str(tmp_path), journal=True, compact_after=3)
+    storage.add_item(1, make_item('a'))
+    storage.add_item(1, make_item('b'))
+    assert os.path.exists(storage._journal_path('1'))
+    assert not os.path.exists(storage._path('1'))
+
+    storage.add_item(1, make_item('c'))
+    assert not os.path.exists(storage._journal_path('1'))
+    with open(storage._path('1')) as f:
+        assert [item['id'] for item in json.load(f)] == ['a', 'b', 'c']
+
+    storage.remove_item(1, 'b')
+    storage = JSONStorage(str(tmp_path), journal=True, compact_after=3)
+    assert [item['id'] for item in storage.load_items(1)] == ['a', 'c']
+
+
+def test_bot_state_journal_compacts(tmp_path):
+    storage = JSONStorage(str(tmp_path), compact_after=2)
+    storage.save_state('user_stats', {'1': {'listings': 1}})
+    storage.save_state('user_stats', {'2': {'listings': 2}, '1': None})
+    assert not os.path.exists(storage._state_journal_path('user_stats'))
+    storage.save_state('user_stats', {'3': {'listings': 3}})
+
+    storage = JSONStorage(str(tmp_path), compact_after=2)
+    assert storage.load_state('user_stats') == {'2': {'listings': 2}, '3': {'listings': 3}}
+
+
+def test_purchase_journal_replay_is_idempotent(tmp_path):
+    storage = JSONStorage(str(tmp_path))
+    storage.save_items(1, [make_item('a'), make_item('b'), make_item('c')])
+    # The batch was journaled, then the crash came after the buyer got 'a' but before
+    # either file was otherwise touched
+    storage.add_purchase(2, make_item('a'))
+    batch = [['2', '1', make_item('a')], ['2', '1', make_item('b')]]
+    with open(os.path.join(str(tmp_path), JSONStorage.PURCHASES_JOURNAL), 'w') as f:
+        f.write(json.dumps(batch) + '\n')
+    storage.close()
+
+    for _ in range(2):
+        storage = JSONStorage(str(tmp_path))
+        assert [item['id'] for item in storage.load_items(1)] == ['c']
+        assert [item['id'] for item in storage.load_purchased(2)] == ['a', 'b']
+        assert not os.path.exists(os.path.join(str(tmp_path), JSONStorage.PURCHASES_JOURNAL))
+        # Replaying the same batch again changes nothing
+        with open(os.path.join(str(tmp_path), JSONStorage.PURCHASES_JOURNAL), 'w') as f:
+            f.write(json.dumps(batch) + '\n')
+        storage.close()
+
+
+def test_commit_purchases_sells_each_item_once(tmp_path):
+    storage = JSONStorage(str(tmp_path))
+    storage.save_items(1, [make_item('a')])
+    assert storage.commit_purchases([(2, 1, make_item('a')), (3, 1, make_item('a'))]) == {'a'}
+    assert storage.commit_purchases([(4, 1, make_item('a'))]) == set()
+    assert [item['id'] for item in storage.load_purchased(2)] == ['a']
+    assert storage.load_purchased(3) == []
+
+
+@pytest.mark.parametrize('journal', [False, True])
+def test_cache_notices_external_edit(tmp_path, journal):
+    backend = JSONStorage(str(tmp_path), journal=journal)
+    storage = CachedStorage(backend, max_bytes=1 << 20)
+    storage.save_items(1, [make_item('a')])
+    assert [item['id'] for item in storage.load_items(1)] == ['a']
+    hits = storage.stats()['hits']
+    assert [item['id'] for item in storage.load_items(1)] == ['a']
+    assert storage.stats()['hits'] == hits + 1
+
+    # Another process (or a person) rewrites the file
+    with open(backend._path('1'), 'w') as f:
+        json.dump([make_item('a'), make_item('edited')], f)
+    assert [item['id'] for item in storage.load_items(1)] == ['a', 'edited']
+
+
+def test_sqlite_remove_items_reports_removed_ids(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / 'bot.db'))
+    storage.save_items(1, [make_item('a'), make_item('b')])
+    assert storage.remove_items(1, ['a', 'missing']) == ['a']
+    assert storage.remove_item(1, 'a') is False
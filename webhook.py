@@ -0,0 +1,99 @@
+import os
+import signal
+import secrets
+import asyncio
+import logging
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Webhook mode: an aiohttp server receives updates from Telegram and puts them on the
+# Application's update queue. Configured from the environment:
+#   WEBHOOK_HOST / WEBHOOK_PORT  address to listen on (default 0.0.0.0:8443)
+#   WEBHOOK_PATH                 URL path of the endpoint (default /telegram)
+#   WEBHOOK_SECRET               checked against X-Telegram-Bot-Api-Secret-Token; updates
+#                                without it are refused
+#   WEBHOOK_URL                  public URL registered with setWebhook; leave empty to skip
+#                                registration (e.g. when testing with fake_telegram.py)
+# With WEBHOOK_URL set and no WEBHOOK_SECRET a random secret is registered along with the
+# URL. Without either the webhook can't tell Telegram's updates from forged ones, so
+# webhook_config() refuses to start.
+# aiohttp is imported by the functions that serve, so SECRET_HEADER and webhook_config()
+# are cheap to import.
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def webhook_config():
+    config = {
+        'host': os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+        'port': int(os.getenv("WEBHOOK_PORT", "8443")),
+        'path': os.getenv("WEBHOOK_PATH", "/telegram"),
+        'secret': os.getenv("WEBHOOK_SECRET") or None,
+        'url': os.getenv("WEBHOOK_URL") or None,
+    }
+    if not config['secret']:
+        if not config['url']:
+            raise ValueError("WEBHOOK_SECRET must be set when the webhook isn't registered through WEBHOOK_URL")
+        config['secret'] = secrets.token_hex(32)
+        logger.info("No WEBHOOK_SECRET set, registering the webhook with a random one")
+    return config
+
+
+def create_web_app(application, path, secret, extra_routes=()):
+    from aiohttp import web
+
+    async def receive_update(request):
+        if request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+
+    web_app = web.Application()
+    web_app.router.add_post(path, receive_update)
+    for extra_path, handler in extra_routes:
+        web_app.router.add_post(extra_path, handler)
+    return web_app
+
+
+async def serve_webhook(application, extra_routes=()):
+    # extra_routes: more (path, handler) POST endpoints, e.g. cluster events
+    from aiohttp import web
+    config = webhook_config()
+    web_app = create_web_app(application, config['path'], config['secret'], extra_routes)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        # run_polling() calls these hooks itself; with our own server we call them here
+        if application.post_init:
+            await application.post_init(application)
+        if config['url']:
+            await application.bot.set_webhook(
+                url=config['url'], secret_token=config['secret'], allowed_updates=Update.ALL_TYPES
+            )
+        await application.start()
+
+        runner = web.AppRunner(web_app)
+        await runner.setup()
+        await web.TCPSite(runner, config['host'], config['port']).start()
+        logger.info("Webhook listening on %s:%d%s", config['host'], config['port'], config['path'])
+
+        await stop_event.wait()
+
+        await runner.cleanup()
+        await application.stop()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def run_webhook(application, extra_routes=()):
+    asyncio.run(serve_webhook(application, extra_routes))